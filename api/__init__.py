@@ -1,8 +1,10 @@
+import multiprocessing
 import re
 import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
 from dataclasses import dataclass
 from datetime import date
-from typing import Callable, Tuple
+from typing import Callable, Tuple, List, Set, Iterator
 
 
 @dataclass
@@ -57,6 +59,7 @@ class FindQuery:
     case: bool = False
     word: bool = False
     orig: bool = False
+    workers: int = 0  # search processes for file databases, 0 or 1 - no pool
 
     def __repr__(self):
         if self.query and self.queryNot:
@@ -143,6 +146,24 @@ def buildFindMatchers(fq: FindQuery) -> Tuple[Callable[[str], int],
     return match, matchNot
 
 
+def carbonMsgs(raw, to, carbonarea):
+    # type: (List[Tuple[str, List[str]]], List[str], Set[str]) -> List[Tuple[str, List[str]]]
+    msgs = []
+    for msgid, msgbody in raw:
+        if msgid not in carbonarea and any(name in msgbody[5] for name in to):
+            carbonarea.add(msgid)
+            msgs.append((msgid, msgbody))
+    return msgs
+
+
+def echoMsgs(raw):
+    # type: (List[Tuple[str, List[str]]]) -> dict[str, List[Tuple[str, List[str]]]]
+    byEcho = {}
+    for msgid, msgbody in raw:
+        byEcho.setdefault(msgbody[1], []).append((msgid, msgbody))
+    return byEcho
+
+
 def txtApiMatch(fq: FindQuery, match, matchNot, msgid, msg) -> bool:
     try:
         if fq.dtFr and date.fromtimestamp(int(msg[2])) < fq.dtFr:
@@ -177,3 +198,51 @@ def txtApiMatch(fq: FindQuery, match, matchNot, msgid, msg) -> bool:
         return True
     #
     return False
+
+
+def findAll(iterQueryMsgids: Callable, fq: FindQuery, progressHandler: Callable,
+            findCancel: int) -> List[MsgMetadata]:
+    # Whole list of found messages, or nothing if the search was cancelled
+    cancelled = False
+
+    def cancelHandler(progress):
+        nonlocal cancelled
+        result = progressHandler(progress)
+        cancelled = cancelled or result == findCancel
+        return result
+
+    findResult = list(iterQueryMsgids(fq, progressHandler and cancelHandler))
+    return [] if cancelled else findResult
+
+
+def findInProcesses(fq: FindQuery, findInEcho: Callable, tasks: List[tuple],
+                    cancel: Callable[[tuple], bool] = None) -> Iterator[MsgMetadata]:
+    # Runs findInEcho(*task) -> (found, scanned) of every echoarea task in
+    # a process pool and yields results in the tasks order. The workers are
+    # spawned, not forked from the threaded UI, and reopen the storage by
+    # the path in the task.
+    findCount = 0
+    totalMsgProgress = 0
+    pool = ProcessPoolExecutor(max_workers=fq.workers,
+                               mp_context=multiprocessing.get_context("spawn"))
+    try:
+        futures = [pool.submit(findInEcho, *task) for task in tasks]
+        for echoProgress, future in enumerate(futures):
+            while True:
+                progress = (echoProgress, len(futures), 0, 0,
+                            totalMsgProgress, findCount)
+                if cancel and cancel(progress):
+                    return
+                try:
+                    found, scanned = future.result(timeout=0.1)
+                    break
+                except TimeoutError:
+                    pass
+            totalMsgProgress += scanned
+            for m in found:
+                if findCount >= fq.limit:
+                    return
+                findCount += 1
+                yield m
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
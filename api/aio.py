@@ -1,9 +1,12 @@
 # coding=utf-8
 import codecs
 import os
-from typing import Optional, List, Callable
+from typing import Optional, List, Callable, Tuple, Iterator
 
-from . import MsgMetadata, FindQuery, filterEchoarea, buildFindMatchers, txtApiMatch
+from . import (
+    MsgMetadata, FindQuery, filterEchoarea, buildFindMatchers, txtApiMatch,
+    carbonMsgs, echoMsgs, findInProcesses, findAll, mat, locator, search,
+)
 
 storage = "aio/"
 
@@ -17,6 +20,7 @@ def init(directory="aio/"):
         os.mkdir(storage)
     if not os.path.exists(storage + "nodes"):
         os.mkdir(storage + "nodes")
+    mat.onTail = _locateTail
 
 
 def getEchoLength(echo):
@@ -33,8 +37,7 @@ def saveToFavorites(msgid, msg):
             favorites = list(map(lambda it: it.split(":")[0],
                                  filter(lambda it: it, f.read().split("\n"))))
     if msgid not in favorites:
-        with codecs.open(storage + "favorites.aio", "a", "utf-8") as f:
-            f.write(msgid + ":" + chr(15).join(msg) + "\n")
+        mat.append(storage + "favorites.aio", [(msgid, msg)])
         return True
     else:
         return False
@@ -54,13 +57,7 @@ def getEchoMsgsMetadata(echo):
     if not os.path.exists(storage + echo + ".aio"):
         return []
 
-    echo_msgs = []
-    with codecs.open(storage + echo + ".aio", "r", "utf-8") as f:
-        for str_msg in filter(None, f.read().split("\n")):
-            msgid, msg = str_msg.split(":", maxsplit=1)
-            msg = msg.split(chr(15))
-            echo_msgs.append(MsgMetadata.fromList(msgid, msg))
-    return echo_msgs
+    return mat.metadata(storage + echo + ".aio", MsgMetadata.fromList)
 
 
 def getCarbonarea():
@@ -73,22 +70,23 @@ def getCarbonarea():
 
 
 def addToCarbonarea(msgid, msgbody):
-    with codecs.open(storage + "carbonarea.aio", "a", "utf-8") as f:
-        f.write(msgid + ":" + chr(15).join(msgbody) + "\n")
+    _addToCarbonarea([(msgid, msgbody)])
+
+
+def _addToCarbonarea(msgs):  # type: (List[Tuple[str, List[str]]]) -> None
+    mat.append(storage + "carbonarea.aio", msgs)
 
 
 # noinspection PyUnusedLocal
 def saveMessage(raw, node, to):
-    for msg in raw:
-        msgid = msg[0]
-        msgbody = msg[1]
-        with codecs.open(storage + msgbody[1] + ".aio", "a", "utf-8") as f:
-            f.write(msgid + ":" + chr(15).join(msgbody) + "\n")
-        if to:
-            carbonarea = getCarbonarea()
-            for name in to:
-                if name in msgbody[5] and msgid not in carbonarea:
-                    addToCarbonarea(msgid, msgbody)
+    located = []
+    for echo, msgs in echoMsgs(raw).items():
+        located.extend((m, echo, o) for m, o in mat.append(storage + echo + ".aio", msgs))
+    locator.put(storage, located)
+    if to:
+        carbon = carbonMsgs(raw, to, set(getCarbonarea()))
+        if carbon:
+            _addToCarbonarea(carbon)
 
 
 def getFavoritesList():
@@ -105,44 +103,123 @@ def removeFromFavorites(msgid):
                                 f.read().split("\n")))
     with codecs.open(storage + "favorites.aio", "w", "utf-8") as f:
         f.write("\n".join(favorites))
+    mat.invalidate(storage + "favorites.aio")
 
 
 def removeEchoarea(echoarea):
     if os.path.exists(storage + "%s.aio" % echoarea):
         os.remove(storage + "%s.aio" % echoarea)
+    mat.invalidate(storage + "%s.aio" % echoarea)
+    locator.removeEcho(storage, echoarea)
+    search.removeEcho(storage, echoarea)
 
 
 def readMsg(msgid, echoarea):
     if not os.path.exists(storage + echoarea + ".aio") or not msgid:
         return ["", "", "", "", "", "", "", "", "Сообщение отсутствует в базе"], 0
 
-    with codecs.open(storage + echoarea + ".aio", "r", "utf-8") as f:
-        index = list(filter(lambda i: i.startswith(msgid),
-                            f.read().split("\n")))
-    msg = None
+    msg = mat.readMsg(storage + echoarea + ".aio", msgid)
     size = 0
-    if index:
-        msg = ":".join(index[-1].split(":")[1:]).split(chr(15))
     if msg:
         size = len("\n".join(msg).encode("utf-8"))
     return msg, size
 
 
-def findMsg(msgid):
-    for echo in os.listdir(storage):
-        if echo in ("carbonarea.aio", "favorites.aio") or not echo.endswith(".aio"):
-            continue  # not echo
+def _locateTail(path, items):  # type: (str, List[Tuple[str, int]]) -> None
+    # messages appended by another tool, indexed by mat
+    echo = os.path.basename(path)
+    if (os.path.dirname(path) + "/" == storage and echo.endswith(".aio")
+            and echo not in ("carbonarea.aio", "favorites.aio")):
+        locator.put(storage, [(m, echo[0:-len(".aio")], o) for m, o in items])
 
-        with codecs.open(storage + echo, "r", "utf-8") as f:
-            index = list(filter(lambda it: it.startswith(msgid + ":"),
-                                f.read().split("\n")))
-        if index:
-            msg = ":".join(index[-1].split(":")[1:]).split(chr(15))
-            size = len("\n".join(msg).encode("utf-8"))
-            return msg, size
+
+def _readLocated(msgid):  # type: (str) -> Optional[List[str]]
+    located = locator.get(storage, msgid)
+    if located and os.path.exists(storage + located[0] + ".aio"):
+        echo = storage + located[0] + ".aio"
+        return mat.readLine(echo, located[1], msgid) or mat.readMsg(echo, msgid)
+    return None
+
+
+def findMsg(msgid):
+    if not locator.isBuilt(storage):
+        _rebuildLocator()
+    msg = _readLocated(msgid)
+    if not msg:
+        # appended by another tool: index the tails only, _locateTail puts them
+        for echo in os.listdir(storage):
+            if (echo.endswith(".aio") and echo not in ("carbonarea.aio", "favorites.aio")
+                    and not mat.isIndexed(storage + echo)):
+                mat.msgOffsets(storage + echo)
+        msg = _readLocated(msgid)
+    if msg:
+        return msg, len("\n".join(msg).encode("utf-8"))
     return ["", "", "", "", "", "", "", "", "Сообщение отсутствует в базе"], 0
 
 
+def rebuildIndex():
+    _rebuildLocator()
+    search.clear(storage)
+    _updateSearch()
+
+
+def _rebuildLocator():
+    echoareas = sorted(list(filter(
+        lambda e: e.endswith(".aio") and e not in ("favorites.aio",
+                                                   "carbonarea.aio"),
+        os.listdir(storage))))
+    items = []
+    for echo in echoareas:
+        items += locator.echoItems(echo[0:-len(".aio")],
+                                   mat.msgOffsets(storage + echo))
+    locator.rebuild(storage, items)
+
+
+def _echoMsgs(echo, msgids=None):
+    # type: (str, Optional[List[str]]) -> List[Tuple[str, List[str]]]
+    if msgids is not None:
+        return [(msgid, msg) for msgid, msg in
+                ((msgid, mat.readMsg(storage + echo + ".aio", msgid)) for msgid in msgids)
+                if msg]
+    with codecs.open(storage + echo + ".aio", "r", "utf-8") as f:
+        lines = filter(None, f.read().split("\n"))
+    return [(msgid, msg.split(chr(15)))
+            for msgid, msg in map(lambda it: it.split(":", maxsplit=1), lines)]
+
+
+def _tailMsgs(path, start, end):
+    # type: (str, int, int) -> List[Tuple[str, List[str]]]
+    with open(path, "rb") as f:
+        f.seek(start)
+        lines = filter(None, f.read(end - start).decode("utf-8").split("\n"))
+    return [(msgid, msg.split(chr(15)))
+            for msgid, msg in map(lambda it: it.split(":", maxsplit=1), lines)]
+
+
+def _updateSearch(progressHandler=None):  # type: (Callable) -> bool
+    echoareas = sorted(list(filter(
+        lambda e: e.endswith(".aio") and e not in ("favorites.aio",
+                                                   "carbonarea.aio"),
+        os.listdir(storage))))
+    echoMsgs = [(echo[0:-len(".aio")], os.stat(storage + echo).st_size,
+                 lambda start, end, echo=echo: _tailMsgs(storage + echo, start, end))
+                for echo in echoareas]
+    cancel = None
+    if progressHandler:
+        def cancel(echoProgress, totalEchoareas, totalMsgProgress):
+            progress = (echoProgress, totalEchoareas, 0, 0, totalMsgProgress, 0)
+            return progressHandler(progress) == FIND_CANCEL
+    return search.update(storage, echoMsgs, cancel)
+
+
+def beginImport():
+    pass  # appends are not slowed down by indexes
+
+
+def endImport():
+    pass
+
+
 def findSubjMsgids(echoarea, subj):
     # type: (Optional[str], str) -> List[str]
     if subj.startswith("Re: "):
@@ -162,12 +239,9 @@ def findSubjMsgids(echoarea, subj):
 
     threadMsgs = []
     for echo in echoareas:
-        with codecs.open(storage + echo, "r", "utf-8") as f:
-            for strMsg in filter(None, f.read().split("\n")):
-                msgid, msg = strMsg.split(":", maxsplit=1)
-                msg = msg.split(chr(15))
-                if msg[6] in (subj, subjRe, subjReSpace):
-                    threadMsgs.append(MsgMetadata.fromList(msgid, msg))
+        for msgid, header in mat.headers(storage + echo):
+            if header[6] in (subj, subjRe, subjReSpace):
+                threadMsgs.append(MsgMetadata.fromList(msgid, header))
     return threadMsgs
 
 
@@ -177,45 +251,79 @@ FIND_OK = 0
 
 def findQueryMsgids(fq: FindQuery,
                     progressHandler: Callable = None) -> List[MsgMetadata]:
+    return findAll(iterQueryMsgids, fq, progressHandler, FIND_CANCEL)
+
+
+def iterQueryMsgids(fq: FindQuery,
+                    progressHandler: Callable = None) -> Iterator[MsgMetadata]:
     echoareas = sorted(list(filter(
         lambda e: e.endswith(".aio") and e not in ("favorites.aio",
                                                    "carbonarea.aio"),
         os.listdir(storage))))
     echoareas = filterEchoarea(fq, echoareas, len(".aio"))
     #
-    findResult = []
+    found = None
+    if search.canNarrow(fq) and _updateSearch(progressHandler):
+        found = search.candidates(storage, fq)  # only these may match
+    if fq.workers > 1 and len(echoareas) > 1:
+        yield from _findInProcesses(fq, [e[0:-len(".aio")] for e in echoareas],
+                                     found, progressHandler)
+        return
+    findCount = 0
     totalMsgProgress = 0
     echoProgress = 0
     totalEchoareas = len(echoareas)
     match, matchNot = buildFindMatchers(fq)
 
     for echo in echoareas:
-        with codecs.open(storage + echo, "r", "utf-8") as f:
-            echo_msgs = list(filter(None, f.read().split("\n")))
+        echo = echo[0:-len(".aio")]
+        echo_msgs = _echoMsgs(echo, None if found is None else found.get(echo, []))
         echoProgress += 1
         echoMsgProgress = 0
         echoTotalMsgs = len(echo_msgs)
 
-        for msg in echo_msgs:
-            if len(findResult) >= fq.limit:
-                return findResult  #
+        for msgid_, msg in echo_msgs:
+            if findCount >= fq.limit:
+                return  #
             #
             totalMsgProgress += 1
             echoMsgProgress += 1
             if progressHandler:
                 progress = (echoProgress, totalEchoareas,
                             echoMsgProgress, echoTotalMsgs,
-                            totalMsgProgress, len(findResult))
+                            totalMsgProgress, findCount)
                 if progressHandler(progress) == FIND_CANCEL:
-                    return []
+                    return
             #
-            msg = msg.split(chr(15))
-            msgid_, msg[0] = msg[0].split(":")
-
             if txtApiMatch(fq, match, matchNot, msgid_, msg):
-                findResult.append(MsgMetadata.fromList(msgid_, msg))
+                findCount += 1
+                yield MsgMetadata.fromList(msgid_, msg)
+
 
-    return findResult
+def _findInEcho(storage_, echo, fq, msgids):
+    # type: (str, str, FindQuery, Optional[List[str]]) -> (List[MsgMetadata], int)
+    global storage
+    storage = storage_  # in a worker process
+    match, matchNot = buildFindMatchers(fq)
+    echoMsgs = _echoMsgs(echo, msgids)
+    found = []
+    for msgid_, msg in echoMsgs:
+        if len(found) >= fq.limit:
+            break
+        if txtApiMatch(fq, match, matchNot, msgid_, msg):
+            found.append(MsgMetadata.fromList(msgid_, msg))
+    return found, len(echoMsgs)
+
+
+def _findInProcesses(fq, echoareas, found, progressHandler):
+    # type: (FindQuery, List[str], Optional[dict[str, List[str]]], Callable) -> Iterator[MsgMetadata]
+    tasks = [(storage, echo, fq, None if found is None else found[echo])
+             for echo in echoareas if found is None or echo in found]
+    cancel = None
+    if progressHandler:
+        def cancel(progress):
+            return progressHandler(progress) == FIND_CANCEL
+    return findInProcesses(fq, _findInEcho, tasks, cancel)
 
 
 def getNodeFeatures(node):  # type: (str) -> Optional[List[str]]
@@ -251,3 +359,21 @@ def saveNodeEchoCounts(node, echo_counts):  # type: (str, dict[str, int]) -> Non
     xCounts = storage + "nodes/" + node + ".x-counts"
     with open(xCounts, "w") as f:
         f.writelines(ec)
+
+
+def getNodeEchoHashes(node):  # type: (str) -> Optional[dict[str, str]]
+    xHashes = storage + "nodes/" + node + ".x-hashes"
+    if not os.path.exists(xHashes):
+        return None  #
+
+    with open(xHashes, "r") as f:
+        echoHashes = list(filter(None, map(lambda it: it.strip().split(":"),
+                                           f.read().splitlines())))
+        return {echo[0]: echo[1] for echo in echoHashes}
+
+
+def saveNodeEchoHashes(node, echo_hashes):  # type: (str, dict[str, str]) -> None
+    eh = ["%s:%s\n" % (echo, h) for echo, h in echo_hashes.items()]
+    xHashes = storage + "nodes/" + node + ".x-hashes"
+    with open(xHashes, "w") as f:
+        f.writelines(eh)
@@ -0,0 +1,84 @@
+# coding=utf-8
+# Global msgid -> (echoarea, offset) locator of the aio/ait databases,
+# so findMsg reads one line instead of scanning every echo file.
+#
+# The locator is a dbm database in the storage directory. It is filled by
+# saveMessage, cleaned by removeEchoarea and built from the echo .idx
+# sidecars on the first lookup (or by `caesium.py --reindex`).
+import atexit
+import dbm
+import threading
+from typing import Optional, List, Tuple, Iterable
+
+FILE = "locator"
+BUILT = b"\x00built"  # marker: locator covers the whole database
+
+_db = None
+_path = None  # type: Optional[str]
+_lock = threading.RLock()
+
+
+def _open(storage, flag="c"):
+    global _db, _path
+    if _db is None or _path != storage + FILE or flag == "n":
+        close()
+        _db = dbm.open(storage + FILE, flag)
+        _path = storage + FILE
+    return _db
+
+
+def close():
+    global _db, _path
+    with _lock:
+        if _db is not None:
+            _db.close()
+        _db = None
+        _path = None
+
+
+atexit.register(close)
+
+
+def isBuilt(storage):  # type: (str) -> bool
+    with _lock:
+        return BUILT in _open(storage)
+
+
+def get(storage, msgid):  # type: (str, str) -> Optional[Tuple[str, int]]
+    with _lock:
+        value = _open(storage).get(msgid.encode("utf-8"))
+    if value is None:
+        return None
+    echo, offset = value.decode("utf-8").rsplit(":", maxsplit=1)
+    return echo, int(offset)
+
+
+def put(storage, items):  # type: (str, Iterable[Tuple[str, str, int]]) -> None
+    with _lock:
+        db = _open(storage)
+        for msgid, echo, offset in items:
+            db[msgid.encode("utf-8")] = ("%s:%d" % (echo, offset)).encode("utf-8")
+
+
+def removeEcho(storage, echo):  # type: (str, str) -> None
+    echo = echo.encode("utf-8")
+    with _lock:
+        db = _open(storage)
+        keys = [k for k in db.keys()
+                if k != BUILT and db[k].rsplit(b":", maxsplit=1)[0] == echo]
+        for k in keys:
+            del db[k]
+
+
+def rebuild(storage, items):  # type: (str, Iterable[Tuple[str, str, int]]) -> None
+    with _lock:
+        db = _open(storage, "n")
+        put(storage, items)
+        db[BUILT] = b""
+        if hasattr(db, "sync"):
+            db.sync()
+
+
+def echoItems(echo, offsets):
+    # type: (str, dict[str, Tuple[int, int]]) -> List[Tuple[str, str, int]]
+    return [(msgid, echo, o[0]) for msgid, o in offsets.items()]
@@ -0,0 +1,231 @@
+# coding=utf-8
+# Helpers for the line-per-message echo files (.mat of ait, .aio of aio):
+#
+#   msgid:tags<0x0F>echo<0x0F>time<0x0F>fr<0x0F>addr<0x0F>to<0x0F>subj<0x0F>body...
+#
+# Every such file has an .idx sidecar with the byte position and the header
+# of each message line:
+#
+#   msgid:offset:length:tags<0x0F>echo<0x0F>time<0x0F>fr<0x0F>addr<0x0F>to<0x0F>subj
+#
+# so a single message read is one seek plus one read, and a message list is
+# built without touching the bodies at all.
+#
+# The sidecar covers the file from the beginning; when the echo file grows
+# behind our back (old client version, manual copy), only the tail is indexed
+# by walking the memory-mapped file and decoding the header fields only.
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, List, Tuple, Iterator, Callable, TypeVar
+
+T = TypeVar("T")
+IDX = ".idx"
+HEADER_FIELDS = 7  # tags, echo, time, fr, addr, to, subj
+CACHE_SIZE = 8  # echoareas kept in memory
+
+# echo file path -> (indexed bytes, msgid -> (offset, length), [(msgid, header)])
+_cache = OrderedDict()  # type: OrderedDict[str, Tuple[int, dict[str, Tuple[int, int]], List[Tuple[str, List[str]]]]]
+_lock = threading.RLock()
+# echo file path -> (headers of _cache, objects made of them by metadata())
+_metadata = {}  # type: dict[str, Tuple[List[Tuple[str, List[str]]], list]]
+# called with the echo file path and [(msgid, offset)] of a walked tail
+onTail = None  # type: Optional[Callable[[str, List[Tuple[str, int]]], None]]
+
+
+def idxPath(path):  # type: (str) -> str
+    return os.path.splitext(path)[0] + IDX
+
+
+def _readIdx(path):
+    # type: (str) -> Tuple[int, dict[str, Tuple[int, int]], List[Tuple[str, List[str]]]]
+    end = 0
+    offsets = {}
+    headers = []
+    idx = idxPath(path)
+    if not os.path.exists(idx):
+        return end, offsets, headers
+    with open(idx, "r", encoding="utf-8", newline="\n") as f:
+        lines = f.read().split("\n")
+    if not lines[-1]:
+        lines.pop()
+    sep = chr(15)
+    for line in lines:
+        item = line.split(":", maxsplit=3)
+        if len(item) != 4:
+            break  # broken or old format sidecar
+        offset, length = int(item[1]), int(item[2])
+        offsets[item[0]] = (offset, length)
+        headers.append((item[0], item[3].split(sep)))
+        if offset + length >= end:
+            end = offset + length + 1
+    else:
+        return end, offsets, headers
+    os.remove(idx)
+    return 0, {}, []
+
+
+def _idxEnd(path):  # type: (str) -> int
+    # end of the file part covered by the sidecar, from its last line only
+    idx = idxPath(path)
+    if not os.path.exists(idx):
+        return 0
+    with open(idx, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        chunk = 4096
+        while True:
+            start = max(0, size - chunk)
+            f.seek(start)
+            lines = f.read(size - start).split(b"\n")
+            if len(lines) > 2 or start == 0:
+                break
+            chunk *= 4
+    if len(lines) < 2 or lines[-1]:
+        return -1 if size else 0  # no trailing newline: broken sidecar
+    item = lines[-2].split(b":", maxsplit=3)
+    if len(item) != 4 or not item[1].isdigit() or not item[2].isdigit():
+        return -1
+    return int(item[1]) + int(item[2]) + 1
+
+
+def _walk(path, start=0):  # type: (str, int) -> Iterator[Tuple[str, int, int, str]]
+    if not os.path.exists(path) or os.path.getsize(path) <= start:
+        return  # empty file can't be mapped
+    with open(path, "rb") as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        size = len(mm)
+        pos = start
+        while pos < size:
+            eol = mm.find(b"\n", pos)
+            if eol == -1:
+                eol = size
+            end = pos
+            for _ in range(HEADER_FIELDS):
+                end = mm.find(b"\x0f", end + 1, eol)
+                if end == -1:
+                    end = eol
+                    break
+            if end > pos:
+                msgid, header = mm[pos:end].decode("utf-8").split(":", maxsplit=1)
+                yield msgid, pos, eol - pos, header
+            pos = eol + 1
+
+
+def _writeIdx(path, entries, mode="a"):
+    with open(idxPath(path), mode, encoding="utf-8", newline="\n") as f:
+        f.writelines("%s:%d:%d:%s\n" % e for e in entries)
+
+
+def _load(path):
+    # type: (str) -> Tuple[int, dict[str, Tuple[int, int]], List[Tuple[str, List[str]]]]
+    with _lock:  # search may run in a thread
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if path in _cache:
+            _cache.move_to_end(path)
+            end, offsets, headers = _cache[path]
+        else:
+            end, offsets, headers = _readIdx(path)
+        if end > size:  # echo file was rewritten
+            end, offsets, headers = 0, {}, []
+            _writeIdx(path, [], "w")
+        if end < size:
+            entries = list(_walk(path, end))
+            _writeIdx(path, entries)
+            _extend(offsets, headers, entries)
+            end = size
+            if onTail and entries:
+                onTail(path, [(e[0], e[1]) for e in entries])
+        _cache[path] = (end, offsets, headers)
+        while len(_cache) > CACHE_SIZE:
+            _metadata.pop(_cache.popitem(last=False)[0], None)
+        return end, offsets, headers
+
+
+def _extend(offsets, headers, entries):
+    offsets.update((e[0], (e[1], e[2])) for e in entries)
+    headers.extend((e[0], e[3].split(chr(15))) for e in entries)
+
+
+def invalidate(path):  # type: (str) -> None
+    with _lock:
+        _cache.pop(path, None)
+        _metadata.pop(path, None)
+        if os.path.exists(idxPath(path)):
+            os.remove(idxPath(path))
+
+
+def append(path, msgs):
+    # type: (str, List[Tuple[str, List[str]]]) -> List[Tuple[str, int]]
+    with _lock:
+        offsets = headers = None
+        if path not in _cache:  # don't read the whole sidecar just to append
+            end = _idxEnd(path)
+            if end != (os.path.getsize(path) if os.path.exists(path) else 0):
+                end, offsets, headers = _load(path)
+        else:
+            end, offsets, headers = _load(path)
+        entries = []
+        with open(path, "ab") as f:
+            for msgid, msgbody in msgs:
+                line = (msgid + ":" + chr(15).join(msgbody)).encode("utf-8")
+                f.write(line + b"\n")
+                entries.append((msgid, end, len(line),
+                                chr(15).join(msgbody[:HEADER_FIELDS])))
+                end += len(line) + 1
+        _writeIdx(path, entries)
+        if offsets is not None:
+            _extend(offsets, headers, entries)
+            _cache[path] = (end, offsets, headers)
+        return [(e[0], e[1]) for e in entries]
+
+
+def isIndexed(path):  # type: (str) -> bool
+    # the sidecar covers the whole file, without reading the sidecar
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    with _lock:
+        if path in _cache:
+            return _cache[path][0] == size
+    return _idxEnd(path) == size
+
+
+def msgOffsets(path):  # type: (str) -> dict[str, Tuple[int, int]]
+    return _load(path)[1]
+
+
+def readLine(path, offset, msgid):  # type: (str, int, str) -> Optional[List[str]]
+    with open(path, "rb") as f:
+        f.seek(offset)
+        line = f.readline().rstrip(b"\n").decode("utf-8")
+    if not line.startswith(msgid + ":"):
+        return None  # stale offset
+    return line.split(":", maxsplit=1)[1].split(chr(15))
+
+
+def readMsg(path, msgid):  # type: (str, str) -> Optional[List[str]]
+    offsets = _load(path)[1]
+    if msgid not in offsets:
+        return None
+    offset, length = offsets[msgid]
+    with open(path, "rb") as f:
+        f.seek(offset)
+        line = f.read(length).decode("utf-8")
+    return line.split(":", maxsplit=1)[1].split(chr(15))
+
+
+def headers(path):  # type: (str) -> List[Tuple[str, List[str]]]
+    # parsed once with the sidecar, don't modify
+    return _load(path)[2]
+
+
+def metadata(path, factory):  # type: (str, Callable[[str, List[str]], T]) -> List[T]
+    # factory(msgid, header) of every message, made once per message
+    with _lock:
+        headers = _load(path)[2]
+        made = _metadata.get(path)
+        if made is None or made[0] is not headers:
+            made = (headers, [])
+            _metadata[path] = made
+        objects = made[1]
+        objects.extend(factory(msgid, header) for msgid, header in headers[len(objects):])
+        return list(objects)
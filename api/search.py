@@ -0,0 +1,165 @@
+# coding=utf-8
+# Full-text index of the file databases (aio, ait, txt), so findQueryMsgids
+# reads and matches only the candidate messages instead of every message.
+#
+# The index is an sqlite database in the storage directory with an FTS5
+# trigram table: every 3-character substring (case-insensitive) is a term
+# with the posting list of the messages containing it. It is built on the
+# first search (or by `caesium.py --reindex`), and every search indexes the
+# messages appended to the echoes since (read from the indexed file size on),
+# so saveMessage isn't slowed down. It is cleaned by removeEchoarea. The
+# candidates are a superset of the matched messages; they are confirmed by
+# txtApiMatch as before.
+import atexit
+import sqlite3
+import threading
+from typing import Optional, List, Tuple, Iterable, Callable
+
+from . import FindQuery
+
+FILE = "search.db"
+MIN_QUERY = 3  # trigram can't match shorter queries
+
+_con = None  # type: Optional[sqlite3.Connection]
+_path = None  # type: Optional[str]
+_lock = threading.RLock()
+
+
+def _open(storage):  # type: (str) -> Optional[sqlite3.Connection]
+    global _con, _path
+    if _path == storage + FILE:
+        return _con
+    close()
+    _path = storage + FILE
+    _con = sqlite3.connect(_path, check_same_thread=False)
+    try:
+        _create(_con)
+    except sqlite3.OperationalError:
+        _con.close()
+        _con = None  # no fts5 or trigram in this sqlite build
+    return _con
+
+
+def _create(con):  # type: (sqlite3.Connection) -> None
+    # contentless: the text itself stays in the echo files
+    con.execute("CREATE VIRTUAL TABLE IF NOT EXISTS msg_fts USING fts5("
+                " subject, fr, t, body,"
+                " content = '', tokenize = 'trigram case_sensitive 0');")
+    con.execute("""CREATE TABLE IF NOT EXISTS doc(
+        id     INTEGER PRIMARY KEY AUTOINCREMENT,
+        msgid  TEXT,
+        echo   TEXT);""")
+    con.execute("CREATE INDEX IF NOT EXISTS doc_msgid ON doc (msgid);")
+    con.execute("CREATE INDEX IF NOT EXISTS doc_echo ON doc (echo);")
+    con.execute("CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT);")
+    con.commit()
+
+
+def close():
+    global _con, _path
+    with _lock:
+        if _con is not None:
+            _con.close()
+        _con = None
+        _path = None
+
+
+atexit.register(close)
+
+
+def isBuilt(storage):  # type: (str) -> bool
+    with _lock:
+        con = _open(storage)
+        return bool(con and con.execute(
+            "SELECT 1 FROM meta WHERE key = 'built';").fetchone())
+
+
+def _add(con, msgs):
+    # type: (sqlite3.Connection, Iterable[Tuple[str, List[str]]]) -> None
+    for msgid, msgbody in msgs:
+        docid = con.execute("INSERT INTO doc (msgid, echo) VALUES (?, ?);",
+                            (msgid, msgbody[1])).lastrowid
+        con.execute("INSERT INTO msg_fts (rowid, subject, fr, t, body)"
+                    " VALUES (?, ?, ?, ?, ?);",
+                    (docid, msgbody[6], msgbody[3], msgbody[5],
+                     "\n".join(msgbody[7:])))
+
+
+def removeEcho(storage, echo):  # type: (str, str) -> None
+    with _lock:
+        con = _open(storage)
+        if con:
+            # contentless fts rows of removed docs never become candidates
+            # and are dropped on rebuild
+            con.execute("DELETE FROM doc WHERE echo = ?;", (echo,))
+            con.execute("DELETE FROM meta WHERE key = ?;", ("size:" + echo,))
+            con.commit()
+
+
+def clear(storage):  # type: (str) -> None
+    with _lock:
+        con = _open(storage)
+        if con:
+            con.execute("DROP TABLE msg_fts;")
+            con.execute("DROP TABLE doc;")
+            con.execute("DELETE FROM meta;")
+            _create(con)
+
+
+def update(storage, echoMsgs, cancel=None):
+    # type: (str, List[Tuple[str, int, Callable[[int, int], List]]], Callable[[int, int, int], bool]) -> bool
+    # echoMsgs: (echo, file size, messages of the file bytes [start, end))
+    with _lock:
+        con = _open(storage)
+        if not con:
+            return False
+        sizes = {key[len("size:"):]: int(value) for key, value in con.execute(
+            "SELECT key, value FROM meta WHERE key LIKE 'size:%';")}
+        count = 0
+        for i, (echo, size, msgs) in enumerate(echoMsgs):
+            if cancel and cancel(i + 1, len(echoMsgs), count):
+                return False  # indexed echoes are kept
+            if sizes.get(echo) == size:
+                continue  # not changed since indexed
+            indexed = sizes.get(echo, 0)
+            if size < indexed:  # rewritten, not appended
+                con.execute("DELETE FROM doc WHERE echo = ?;", (echo,))
+                indexed = 0
+            msgs = msgs(indexed, size)  # appended messages only
+            _add(con, msgs)
+            count += len(msgs)
+            con.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?);",
+                        ("size:" + echo, str(size)))
+            con.commit()
+        con.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('built', '1');")
+        con.commit()
+        return True
+
+
+def canNarrow(fq: FindQuery) -> bool:
+    return (not fq.regex and len(fq.query) >= MIN_QUERY
+            and (fq.body or fq.subj or fq.fr or fq.to))
+
+
+def candidates(storage, fq: FindQuery):
+    # type: (str, FindQuery) -> Optional[dict[str, List[str]]]
+    if not canNarrow(fq):
+        return None
+    columns = [col for col, on in (("body", fq.body), ("subject", fq.subj),
+                                   ("fr", fq.fr), ("t", fq.to)) if on]
+    query = '{%s} : "%s"' % (" ".join(columns), fq.query.replace('"', '""'))
+    sql = ("SELECT id, echo, msgid FROM doc"
+           " WHERE id IN (SELECT rowid FROM msg_fts WHERE msg_fts MATCH ?)")
+    args = [query]
+    if fq.msgid:
+        sql += " OR msgid = ?"
+        args.append(fq.query)
+    with _lock:
+        con = _open(storage)
+        if not con:
+            return None
+        rows = con.execute(sql + " ORDER BY id;", args).fetchall()
+    found = {}
+    for _, echo, msgid in rows:
+        found.setdefault(echo, []).append(msgid)
+    return found
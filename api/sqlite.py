@@ -1,13 +1,51 @@
 # coding=utf-8
+import json
 import sqlite3
+import threading
 from datetime import datetime
-from typing import Optional, List, Callable
+from typing import Optional, List, Callable, Tuple, Iterator
 
-from . import MsgMetadata, FindQuery, buildFindMatcher
-from core import FEAT_FEATURES, FEAT_X_C
+from . import MsgMetadata, FindQuery, buildFindMatcher, carbonMsgs, findAll
+from core import FEAT_FEATURES, FEAT_X_C, FEAT_X_H
 
 con = None  # type: Optional[sqlite3.Connection]
 c = None  # type: Optional[sqlite3.Cursor]
+dbPath = None  # type: Optional[str]
+owner = None  # type: Optional[int]  # thread of init(), owning con
+_local = threading.local()
+
+# Secondary msg indexes, dropped for the initial import (beginImport).
+# The msgid one is kept: saveMessage and findMsg look msgids up.
+MSG_INDEXES = {
+    "echoarea": "CREATE INDEX IF NOT EXISTS echoarea ON 'msg' ('echoarea');",
+    "time": "CREATE INDEX IF NOT EXISTS time     ON 'msg' ('time');",
+    "subject": "CREATE INDEX IF NOT EXISTS subject  ON 'msg' ('subject');",
+    "body": "CREATE INDEX IF NOT EXISTS body     ON 'msg' ('body');",
+}
+
+# Full-text index of the searchable msg columns. The trigram tokenizer finds
+# any substring of 3+ characters (not only words), case-insensitive for
+# unicode too, so findQueryMsgids gets its candidates from here instead of
+# calling the Python matcher on every row.
+fts = False  # msg_fts available
+FTS_MIN_QUERY = 3  # trigram can't match shorter queries
+FTS_TRIGGER_INSERT = """CREATE TRIGGER IF NOT EXISTS msg_fts_insert AFTER INSERT ON msg BEGIN
+        INSERT INTO msg_fts (rowid, subject, fr, t, body)
+        VALUES (new.id, new.subject, new.fr, new.t, new.body);
+    END;"""
+FTS_TRIGGERS = (
+    FTS_TRIGGER_INSERT,
+    """CREATE TRIGGER IF NOT EXISTS msg_fts_delete AFTER DELETE ON msg BEGIN
+        INSERT INTO msg_fts (msg_fts, rowid, subject, fr, t, body)
+        VALUES ('delete', old.id, old.subject, old.fr, old.t, old.body);
+    END;""",
+    """CREATE TRIGGER IF NOT EXISTS msg_fts_update AFTER UPDATE OF subject, fr, t, body ON msg BEGIN
+        INSERT INTO msg_fts (msg_fts, rowid, subject, fr, t, body)
+        VALUES ('delete', old.id, old.subject, old.fr, old.t, old.body);
+        INSERT INTO msg_fts (rowid, subject, fr, t, body)
+        VALUES (new.id, new.subject, new.fr, new.t, new.body);
+    END;""",
+)
 
 
 # Frequently Asked Questions
@@ -22,7 +60,9 @@ c = None  # type: Optional[sqlite3.Cursor]
 
 
 def init(db="idec.db"):
-    global con, c
+    global con, c, fts, dbPath, owner
+    dbPath = db
+    owner = threading.get_ident()
     con = sqlite3.connect(db)
     c = con.cursor()
 
@@ -41,10 +81,10 @@ def init(db="idec.db"):
         subject    TEXT,
         body       TEXT);""")
     c.execute("CREATE INDEX IF NOT EXISTS msgid    ON 'msg' ('msgid');")
-    c.execute("CREATE INDEX IF NOT EXISTS echoarea ON 'msg' ('echoarea');")
-    c.execute("CREATE INDEX IF NOT EXISTS time     ON 'msg' ('time');")
-    c.execute("CREATE INDEX IF NOT EXISTS subject  ON 'msg' ('subject');")
-    c.execute("CREATE INDEX IF NOT EXISTS body     ON 'msg' ('body');")
+    for index in MSG_INDEXES.values():
+        c.execute(index)
+
+    fts = _initFts()
 
     c.execute("""CREATE TABLE IF NOT EXISTS node_feature(
         node        TEXT,
@@ -57,6 +97,27 @@ def init(db="idec.db"):
     con.commit()
 
 
+def _initFts():  # type: () -> bool
+    exists = c.execute("SELECT 1 FROM sqlite_master"
+                       " WHERE type = 'table' AND name = 'msg_fts';").fetchone()
+    if not exists:
+        try:
+            c.execute("CREATE VIRTUAL TABLE msg_fts USING fts5("
+                      " subject, fr, t, body,"
+                      " content = 'msg', content_rowid = 'id',"
+                      " tokenize = 'trigram case_sensitive 0');")
+        except sqlite3.OperationalError:
+            return False  # no fts5 or trigram in this sqlite build
+        c.execute("INSERT INTO msg_fts (msg_fts) VALUES ('rebuild');")
+    elif not c.execute("SELECT 1 FROM sqlite_master"
+                       " WHERE type = 'trigger' AND name = 'msg_fts_insert';").fetchone():
+        # import interrupted before endImport, msg_fts isn't backfilled
+        c.execute("INSERT INTO msg_fts (msg_fts) VALUES ('rebuild');")
+    for trigger in FTS_TRIGGERS:
+        c.execute(trigger)
+    return True
+
+
 def getEchoLength(echo):
     row = c.execute("SELECT COUNT(1) FROM msg WHERE echoarea = ?;",
                     (echo,)).fetchone()
@@ -109,34 +170,55 @@ def getCarbonarea():
     return msgids
 
 
-# noinspection PyUnusedLocal
 def addToCarbonarea(msgid, msgbody):
-    c.execute("UPDATE msg SET carbonarea = 1 WHERE msgid = ?;",
-              (msgid,))
+    _addToCarbonarea([(msgid, msgbody)])
+
+
+def _addToCarbonarea(msgs):  # type: (List[Tuple[str, List[str]]]) -> None
+    c.executemany("UPDATE msg SET carbonarea = 1 WHERE msgid = ?;",
+                  ((msgid,) for msgid, _ in msgs))
     con.commit()
 
 
+def _carbonMsgids(msgids):  # type: (List[str]) -> List[str]
+    return [row[0] for row in c.execute(
+        "SELECT msgid FROM msg WHERE carbonarea = 1"
+        " AND msgid IN (SELECT value FROM json_each(?));",
+        (json.dumps(msgids),))]
+
+
 # noinspection PyUnusedLocal
 def saveMessage(raw, node, to):
-    for msg in raw:
-        msgid = msg[0]
-        msgbody = msg[1]
-        c.execute(
-            "INSERT INTO msg ("
-            " msgid, tags, echoarea, time, fr, addr,"
-            " t, subject, body"
-            ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);",
-            (msgid, msgbody[0], msgbody[1], msgbody[2], msgbody[3], msgbody[4],
-             msgbody[5], msgbody[6], "\n".join(msgbody[7:])))
+    carbon = set()
+    if to:
+        carbonarea = set(_carbonMsgids([msg[0] for msg in raw]))
+        carbon = set(m[0] for m in carbonMsgs(raw, to, carbonarea))
+    c.executemany(
+        "INSERT INTO msg ("
+        " msgid, carbonarea, tags, echoarea, time, fr, addr,"
+        " t, subject, body"
+        ") VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);",
+        ((msgid, int(msgid in carbon), msgbody[0], msgbody[1], msgbody[2],
+          msgbody[3], msgbody[4], msgbody[5], msgbody[6], "\n".join(msgbody[7:]))
+         for msgid, msgbody in raw))
+    con.commit()
+
+
+def beginImport():
+    for index in MSG_INDEXES:
+        c.execute("DROP INDEX IF EXISTS %s;" % index)
+    if fts:
+        c.execute("DROP TRIGGER IF EXISTS msg_fts_insert;")
+    con.commit()
+
+
+def endImport():
+    for index in MSG_INDEXES.values():
+        c.execute(index)
+    if fts:
+        c.execute("INSERT INTO msg_fts (msg_fts) VALUES ('rebuild');")
+        c.execute(FTS_TRIGGER_INSERT)
     con.commit()
-    for msg in raw:
-        msgid = msg[0]
-        msgbody = msg[1]
-        if to:
-            carbonarea = getCarbonarea()
-            for name in to:
-                if name in msgbody[5] and msgid not in carbonarea:
-                    addToCarbonarea(msgid, msgbody)
 
 
 def getFavoritesList():
@@ -156,11 +238,21 @@ def removeEchoarea(echoarea):
     con.commit()
 
 
+def _cursor():  # type: () -> sqlite3.Cursor
+    # own connection in other threads, e.g. the reader prefetching messages
+    if threading.get_ident() == owner:
+        return c
+    if getattr(_local, "dbPath", None) != dbPath:
+        _local.con = sqlite3.connect(dbPath)
+        _local.dbPath = dbPath
+    return _local.con.cursor()
+
+
 # noinspection PyUnusedLocal
 def readMsg(msgid, echoarea):
-    row = c.execute("SELECT tags, echoarea, time, fr, addr, t, subject, body"
-                    " FROM msg WHERE msgid = ?;",
-                    (msgid,)).fetchone()
+    row = _cursor().execute("SELECT tags, echoarea, time, fr, addr, t, subject, body"
+                            " FROM msg WHERE msgid = ?;",
+                            (msgid,)).fetchone()
     if not row:
         return ["", "", "", "", "", "", "", "", "Сообщение отсутствует в базе"], 0
     msg = "\n".join((row[0], row[1], str(row[2]), row[3],
@@ -174,6 +266,13 @@ def findMsg(msgid):
     return readMsg(msgid, None)
 
 
+def rebuildIndex():
+    c.execute("REINDEX msg;")
+    if fts:
+        c.execute("INSERT INTO msg_fts (msg_fts) VALUES ('rebuild');")
+    con.commit()
+
+
 def findSubjMsgids(echoarea, subj):  # type: (str, str) -> List[str]
     if subj.startswith("Re: "):
         subj = subj[4:]
@@ -201,11 +300,42 @@ FIND_CANCEL = 1
 FIND_OK = 0
 
 
+def _findColumns(fq: FindQuery) -> List[str]:
+    return [col for col, on in (("body", fq.body), ("subject", fq.subj),
+                                ("fr", fq.fr), ("t", fq.to)) if on]
+
+
+def _ftsQuery(query, fq: FindQuery) -> Optional[str]:
+    columns = _findColumns(fq)
+    if not fts or fq.regex or len(query) < FTS_MIN_QUERY or not columns:
+        return None
+    return '{%s} : "%s"' % (" ".join(columns), query.replace('"', '""'))
+
+
+def _matchWhere(func, query, fq: FindQuery, isFts):
+    # type: (str, str, FindQuery, bool) -> (List[str], List[str])
+    columns = _findColumns(fq)
+    if not isFts or fq.word or not fq.orig:
+        return ["%s(%s)" % (func, col) for col in columns], []
+    if fq.case:  # fts is case-insensitive
+        return ["instr(%s, ?)" % col for col in columns], [query] * len(columns)
+    return ["TRUE"], []  # exactly what fts has found
+
+
 def findQueryMsgids(fq: FindQuery,
                     progressHandler: Callable = None) -> List[MsgMetadata]:
+    return findAll(iterQueryMsgids, fq, progressHandler, FIND_CANCEL)
+
+
+def iterQueryMsgids(fq: FindQuery,
+                    progressHandler: Callable = None) -> Iterator[MsgMetadata]:
+    # own connection, the search may run in a thread while UI reads messages
+    scon = sqlite3.connect(dbPath)
+    sc = scon.cursor()
     args = []
     where = []
     progress = 0
+    findCount = 0
 
     # noinspection PyUnusedLocal
     def countMsg(arg):
@@ -213,23 +343,33 @@ def findQueryMsgids(fq: FindQuery,
         progress += 1
         return 1  # always TRUE
 
-    con.create_function("PROGRESS", 1, countMsg)
+    scon.create_function("PROGRESS", 1, countMsg)
 
+    count_where = "TRUE"
+    count_args = []
     if fq.query:
         match = buildFindMatcher(fq.query, fq)
-        con.create_function("MATCH", 1, match)
+        scon.create_function("MATCH", 1, match)
 
+        ftsQuery = _ftsQuery(fq.query, fq)
         if fq.msgid:
             where.append("msgid = ?")
             args.append(fq.query)
-        if fq.body:
-            where.append("MATCH(body)")
-        if fq.subj:
-            where.append("MATCH(subject)")
-        if fq.fr:
-            where.append("MATCH(fr)")
-        if fq.to:
-            where.append("MATCH(t)")
+        matches, matchArgs = _matchWhere("MATCH", fq.query, fq, bool(ftsQuery))
+        where += matches
+        args += matchArgs
+        if ftsQuery:
+            # search only the rows found by fts (or by msgid)
+            candidates = "id IN (SELECT rowid FROM msg_fts WHERE msg_fts MATCH ?"
+            candidatesArgs = [ftsQuery]
+            if fq.msgid:
+                candidates += " UNION SELECT id FROM msg WHERE msgid = ?"
+                candidatesArgs.append(fq.query)
+            candidates += ")"
+            where = [candidates + " AND (" + " OR ".join(where) + ")"]
+            args = candidatesArgs + args
+            count_where = candidates
+            count_args = list(candidatesArgs)
 
     if where:
         where = "PROGRESS(msgid) AND (" + " OR ".join(where) + ")"
@@ -238,22 +378,18 @@ def findQueryMsgids(fq: FindQuery,
 
     if fq.queryNot:
         matchNot = buildFindMatcher(fq.queryNot, fq)
-        con.create_function("MATCH_NOT", 1, matchNot)
-
-        whereNot = []
-        if fq.body:
-            whereNot.append("NOT MATCH_NOT(body)")
-        if fq.subj:
-            whereNot.append("NOT MATCH_NOT(subject)")
-        if fq.fr:
-            whereNot.append("NOT MATCH_NOT(fr)")
-        if fq.to:
-            whereNot.append("NOT MATCH_NOT(t)")
-        if whereNot:
-            where += " AND (" + " AND ".join(whereNot) + ")"
-
-    count_where = "TRUE"
-    count_args = []
+        scon.create_function("MATCH_NOT", 1, matchNot)
+
+        ftsQuery = _ftsQuery(fq.queryNot, fq)
+        matches, matchArgs = _matchWhere("MATCH_NOT", fq.queryNot, fq, bool(ftsQuery))
+        if matches:
+            if ftsQuery:
+                where += (" AND NOT (id IN (SELECT rowid FROM msg_fts WHERE msg_fts MATCH ?)"
+                          " AND (" + " OR ".join(matches) + "))")
+                args += [ftsQuery] + matchArgs
+            else:
+                where += " AND NOT (" + " OR ".join(matches) + ")"
+                args += matchArgs
     if fq.dtFr:
         dtFr = int(datetime.combine(fq.dtFr, datetime.min.time()).timestamp())
         where += " AND time >= ?"
@@ -292,34 +428,33 @@ def findQueryMsgids(fq: FindQuery,
         count_args.extend(echos)
     try:
         if progressHandler:
-            total = c.execute(
+            total = sc.execute(
                 "SELECT COUNT(DISTINCT msgid)"
                 " FROM msg"
                 " WHERE %s;" % count_where,
                 count_args).fetchone()[0]
 
             def progressHandlerWrapper():
-                return progressHandler((0, 0, 0, 0, progress, 0, total))
+                return progressHandler((0, 0, 0, 0, progress, findCount, total))
 
-            con.set_progress_handler(progressHandlerWrapper, 100)
+            scon.set_progress_handler(progressHandlerWrapper, 100)
 
-        rows = c.execute(
+        rows = sc.execute(
             "SELECT DISTINCT msgid, tags, echoarea, time, fr, addr, t, subject"
             " FROM msg"
             " WHERE %s"
             " ORDER BY id"
             " LIMIT ?;" % where,
             (*args, fq.limit))
-        return list(map(lambda r: MsgMetadata.fromList(r[0], r[1:]), rows))
+        for r in rows:
+            findCount += 1
+            yield MsgMetadata.fromList(r[0], r[1:])
     except sqlite3.OperationalError as ex:
         if "interrupted" == str(ex):
-            return []  #
+            return  #
         raise ex
     finally:
-        con.create_function("PROGRESS", 1, None)
-        con.create_function("MATCH", 1, None)
-        con.create_function("MATCH_NOT", 1, None)
-        con.set_progress_handler(None, 1)
+        scon.close()
 
 
 def getNodeFeatures(node):  # type: (str) -> Optional[List[str]]
@@ -362,3 +497,23 @@ def saveNodeEchoCounts(node, echo_counts):  # type: (str, dict[str, int]) -> Non
     c.execute("INSERT INTO node_feature (node, feature, response) VALUES (?, ?, ?);",
               (node, FEAT_X_C, ec))
     con.commit()
+
+
+def getNodeEchoHashes(node):  # type: (str) -> Optional[dict[str, str]]
+    eh = c.execute("SELECT response FROM node_feature"
+                   " WHERE node = ? AND feature = ?;",
+                   (node, FEAT_X_H)).fetchone()
+    if eh:
+        echoHashes = list(filter(None, map(lambda it: it.strip().split(":"),
+                                           eh[0].splitlines())))
+        return {echo[0]: echo[1] for echo in echoHashes}
+    return None
+
+
+def saveNodeEchoHashes(node, echo_hashes):  # type: (str, dict[str, str]) -> None
+    eh = "".join("%s:%s\n" % (echo, h) for echo, h in echo_hashes.items())
+    c.execute("DELETE FROM node_feature WHERE node = ? AND feature = ?;",
+              (node, FEAT_X_H))
+    c.execute("INSERT INTO node_feature (node, feature, response) VALUES (?, ?, ?);",
+              (node, FEAT_X_H, eh))
+    con.commit()
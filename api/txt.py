@@ -1,9 +1,12 @@
 # coding=utf-8
 import codecs
 import os
-from typing import Optional, List, Callable
+from typing import Optional, List, Callable, Tuple, Iterator
 
-from . import MsgMetadata, FindQuery, filterEchoarea, buildFindMatchers, txtApiMatch
+from . import (
+    MsgMetadata, FindQuery, filterEchoarea, buildFindMatchers, txtApiMatch,
+    carbonMsgs, findInProcesses, findAll, search,
+)
 
 storage = "txt"
 
@@ -95,15 +98,17 @@ def getCarbonarea():
                            f.read().splitlines()))
 
 
-# noinspection PyUnusedLocal
 def addToCarbonarea(msgid, msgbody):
+    _addToCarbonarea([(msgid, msgbody)])
+
+
+def _addToCarbonarea(msgs):  # type: (List[Tuple[str, List[str]]]) -> None
     with codecs.open(storage + "echo/carbonarea", "a", "utf-8") as f:
-        f.write(msgid + "\n")
+        f.writelines(msgid + "\n" for msgid, _ in msgs)
 
 
 # noinspection PyUnusedLocal
 def saveMessage(raw, node, to):
-    carbonarea = getCarbonarea()
     for msg in raw:
         msgid = msg[0]
         msgbody = msg[1]
@@ -111,10 +116,10 @@ def saveMessage(raw, node, to):
             f.write(msgid + "\n")
         with codecs.open(storage + "msg/" + msgid, "w", "utf-8") as f:
             f.write("\n".join(msgbody))
-        if to:
-            for name in to:
-                if name in msgbody[5] and msgid not in carbonarea:
-                    addToCarbonarea(msgid, msgbody)
+    if to:
+        carbon = carbonMsgs(raw, to, set(getCarbonarea()))
+        if carbon:
+            _addToCarbonarea(carbon)
 
 
 def getFavoritesList():
@@ -146,6 +151,7 @@ def removeEchoarea(echoarea):
     #
     if os.path.exists(fEcho):
         os.remove(fEcho)
+    search.removeEcho(storage, echoarea)
 
 
 # noinspection PyUnusedLocal
@@ -160,16 +166,53 @@ def readMsg(msgid, echoarea):
 
 
 def findMsg(msgid):
-    for echo in os.listdir(storage + "echo/"):
-        if echo in ("carbonarea", "favorites"):
-            continue  # not echo
+    return readMsg(msgid, None)  # msg/ directory is the msgid locator
+
+
+def rebuildIndex():
+    search.clear(storage)  # msgid locator is the msg/ directory, see findMsg
+    _updateSearch()
+
+
+def _echoMsgs(echo, msgids=None):
+    # type: (str, Optional[List[str]]) -> List[Tuple[str, List[str]]]
+    msgs = []
+    for msgid in getEchoMsgids(echo) if msgids is None else msgids:
+        if os.path.exists(storage + "msg/" + msgid):
+            with open(storage + "msg/" + msgid, "r") as f:
+                msgs.append((msgid, f.read().split("\n")))
+    return msgs
+
+
+def _tailMsgs(echo, start, end):
+    # type: (str, int, int) -> List[Tuple[str, List[str]]]
+    with open(storage + "echo/" + echo, "rb") as f:
+        f.seek(start)
+        msgids = f.read(end - start).decode("utf-8").split()
+    return _echoMsgs(echo, msgids)
+
+
+def _updateSearch(progressHandler=None):  # type: (Callable) -> bool
+    echoareas = sorted(list(filter(
+        lambda e: e not in ("favorites", "carbonarea"),
+        os.listdir(storage + "echo/"))))
+    echoMsgs = [(echo, os.stat(storage + "echo/" + echo).st_size,
+                 lambda start, end, echo=echo: _tailMsgs(echo, start, end))
+                for echo in echoareas]
+    cancel = None
+    if progressHandler:
+        def cancel(echoProgress, totalEchoareas, totalMsgProgress):
+            progress = (echoProgress, totalEchoareas, 0, 0, totalMsgProgress, 0)
+            return progressHandler(progress) == FIND_CANCEL
+    return search.update(storage, echoMsgs, cancel)
+
 
-        with codecs.open(storage + "echo/" + echo, "r", "utf-8") as f:
-            exists = next(filter(lambda it: it.strip() == msgid,
-                                 f.read().split("\n")), None)
-            if exists:
-                return readMsg(msgid, echo)
-    return ["", "", "", "", "", "", "", "", "Сообщение отсутствует в базе"], 0
+def beginImport():
+    pass  # appends are not slowed down by indexes
+
+
+def endImport():
+    pass
 
 
 def findSubjMsgids(echoarea, subj):
@@ -204,42 +247,78 @@ FIND_OK = 0
 
 def findQueryMsgids(fq: FindQuery,
                     progressHandler: Callable = None) -> List[MsgMetadata]:
+    return findAll(iterQueryMsgids, fq, progressHandler, FIND_CANCEL)
+
+
+def iterQueryMsgids(fq: FindQuery,
+                    progressHandler: Callable = None) -> Iterator[MsgMetadata]:
     echoareas = sorted(list(filter(
         lambda e: e not in ("favorites", "carbonarea"),
         os.listdir(storage + "echo/"))))
     echoareas = filterEchoarea(fq, echoareas, 0)
     #
-    findResult = []
+    found = None
+    if search.canNarrow(fq) and _updateSearch(progressHandler):
+        found = search.candidates(storage, fq)  # only these may match
+    if fq.workers > 1 and len(echoareas) > 1:
+        yield from _findInProcesses(fq, echoareas, found, progressHandler)
+        return
+    findCount = 0
     totalMsgProgress = 0
     echoProgress = 0
     totalEchoareas = len(echoareas)
     match, matchNot = buildFindMatchers(fq)
 
     for echo in echoareas:
-        echoMsgids = getEchoMsgids(echo)
+        echoMsgids = getEchoMsgids(echo) if found is None else found.get(echo, [])
         echoProgress += 1
         echoMsgProgress = 0
         echoTotalMsgs = len(echoMsgids)
 
         for msgid_ in echoMsgids:
-            if len(findResult) >= fq.limit:
-                return findResult
+            if findCount >= fq.limit:
+                return
             totalMsgProgress += 1
             echoMsgProgress += 1
             if progressHandler:
                 progress = (echoProgress, totalEchoareas,
                             echoMsgProgress, echoTotalMsgs,
-                            totalMsgProgress, len(findResult))
+                            totalMsgProgress, findCount)
                 if progressHandler(progress) == FIND_CANCEL:
-                    return []
+                    return
             #
             with open(storage + "msg/" + msgid_, "r") as f:
                 msg = f.read().split("\n")
 
             if txtApiMatch(fq, match, matchNot, msgid_, msg):
-                findResult.append(MsgMetadata.fromList(msgid_, msg))
+                findCount += 1
+                yield MsgMetadata.fromList(msgid_, msg)
+
 
-    return findResult
+def _findInEcho(storage_, echo, fq, msgids):
+    # type: (str, str, FindQuery, Optional[List[str]]) -> (List[MsgMetadata], int)
+    global storage
+    storage = storage_  # in a worker process
+    match, matchNot = buildFindMatchers(fq)
+    echoMsgs = _echoMsgs(echo, msgids)
+    found = []
+    for msgid_, msg in echoMsgs:
+        if len(found) >= fq.limit:
+            break
+        if txtApiMatch(fq, match, matchNot, msgid_, msg):
+            found.append(MsgMetadata.fromList(msgid_, msg))
+    return found, len(echoMsgs)
+
+
+def _findInProcesses(fq, echoareas, found, progressHandler):
+    # type: (FindQuery, List[str], Optional[dict[str, List[str]]], Callable) -> Iterator[MsgMetadata]
+    tasks = [(storage, echo, fq, None if found is None else found[echo])
+             for echo in echoareas if found is None or echo in found]
+    cancel = None
+    if progressHandler:
+        def cancel(progress):
+            return progressHandler(progress) == FIND_CANCEL
+    return findInProcesses(fq, _findInEcho, tasks, cancel)
 
 
 def getNodeFeatures(node):  # type: (str) -> Optional[List[str]]
@@ -275,3 +354,21 @@ def saveNodeEchoCounts(node, echo_counts):  # type: (str, dict[str, int]) -> Non
     xCounts = storage + "nodes/" + node + ".x-counts"
     with open(xCounts, "w") as f:
         f.writelines(ec)
+
+
+def getNodeEchoHashes(node):  # type: (str) -> Optional[dict[str, str]]
+    xHashes = storage + "nodes/" + node + ".x-hashes"
+    if not os.path.exists(xHashes):
+        return None  #
+
+    with open(xHashes, "r") as f:
+        echoHashes = list(filter(None, map(lambda it: it.strip().split(":"),
+                                           f.read().splitlines())))
+        return {echo[0]: echo[1] for echo in echoHashes}
+
+
+def saveNodeEchoHashes(node, echo_hashes):  # type: (str, dict[str, str]) -> None
+    eh = ["%s:%s\n" % (echo, h) for echo, h in echo_hashes.items()]
+    xHashes = storage + "nodes/" + node + ".x-hashes"
+    with open(xHashes, "w") as f:
+        f.writelines(eh)
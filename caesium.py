@@ -87,23 +87,29 @@ def editCfg():
 
 
 API = api.ait
-config.ensureExists()
-CFG.load()
-if not os.path.exists("downloads"):
-    os.mkdir("downloads")
-mailer.init(CFG)
+if __name__ == "__main__":  # not in the spawned find workers
+    config.ensureExists()
+    CFG.load()
+    if "--reindex" in sys.argv[1:]:
+        loadApi(CFG)
+        print("Перестроение индексов базы (%s)..." % CFG.db)
+        API.rebuildIndex()
+        sys.exit(0)
+    if not os.path.exists("downloads"):
+        os.mkdir("downloads")
+    mailer.init(CFG)
 
-try:
-    ui.initializeCurses()
-    ui.loadTheme(CFG)
-    loadKeys(CFG)
-    loadApi(CFG)
-    ui.stdscr.bkgd(" ", curses.color_pair(COLOR_PAIRS[UI_TEXT][0]))  # wo attrs
+    try:
+        ui.initializeCurses()
+        ui.loadTheme(CFG)
+        loadKeys(CFG)
+        loadApi(CFG)
+        ui.stdscr.bkgd(" ", curses.color_pair(COLOR_PAIRS[UI_TEXT][0]))  # wo attrs
 
-    if CFG.splash:
-        ui.drawSplash(ui.stdscr, splash)
-        curses.napms(2000)
-        ui.stdscr.clear()
-    ui.EchoSelectorScreen(ui.stdscr, onEditCfg=editCfg).show()
-finally:
-    ui.terminateCurses()
+        if CFG.splash:
+            ui.drawSplash(ui.stdscr, splash)
+            curses.napms(2000)
+            ui.stdscr.clear()
+        ui.EchoSelectorScreen(ui.stdscr, onEditCfg=editCfg).show()
+    finally:
+        ui.terminateCurses()
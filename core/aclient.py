@@ -0,0 +1,53 @@
+# coding=utf-8
+# asyncio front of core.client for bulk operations (many u/m/ bundles,
+# many u/point uploads): each request runs the blocking client in a thread,
+# sharing its keep-alive connections and rate limits, and at most
+# NODE_REQUESTS requests are sent to a node at once.
+import asyncio
+import weakref
+from typing import List, Tuple
+
+from core import client
+
+NODE_REQUESTS = 4  # concurrent requests per node
+
+# event loop -> node (scheme, host:port) -> semaphore
+_semaphores = weakref.WeakKeyDictionary()  # type: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[Tuple[str, str], asyncio.BoundedSemaphore]]
+
+
+def _semaphore(url):  # type: (str) -> asyncio.BoundedSemaphore
+    nodes = _semaphores.setdefault(asyncio.get_running_loop(), {})
+    key = client.nodeKey(url)
+    if key not in nodes:
+        nodes[key] = asyncio.BoundedSemaphore(NODE_REQUESTS)
+    return nodes[key]
+
+
+async def _request(url, fn, *args):
+    async with _semaphore(url):
+        return await asyncio.to_thread(fn, url, *args)
+
+
+async def getBundle(url, msgids):  # type: (str, str) -> List[str]
+    return await _request(url, client.getBundle, msgids)
+
+
+async def getMsgList(url, echoareas, offset=None, count=65535):
+    # type: (str, List[str], int, int) -> List[str]
+    return await _request(url, client.getMsgList, echoareas, offset, count)
+
+
+async def sendMsg(url, auth, msg_b64):  # type: (str, str, str) -> str
+    return await _request(url, client.sendMsg, auth, msg_b64)
+
+
+async def getEchoCount(url, echoareas):  # type: (str, List[str]) -> dict[str, int]
+    return await _request(url, client.getEchoCount, echoareas)
+
+
+async def getEchoHash(url, echoareas):  # type: (str, List[str]) -> dict[str, str]
+    return await _request(url, client.getEchoHash, echoareas)
+
+
+async def getFeatures(url):  # type: (str) -> List[str]
+    return await _request(url, client.getFeatures)
@@ -1,61 +1,251 @@
 # coding=utf-8
+import atexit
+import codecs
+import functools
+import http.client
+import select
+import threading
+import time
+import urllib.error
 import urllib.parse
 import urllib.request
 import zlib
-from typing import List
+from typing import Callable, Iterator, List, Optional, Tuple
 
 from core import __version__
 
 USER_AGENT = "Caesium/" + __version__
+TIMEOUT = 60  # seconds
+POOL_SIZE = 8  # idle connections kept per node
+MAX_REDIRECTS = 5
+CHUNK_SIZE = 64 * 1024  # bytes read at once by _iterLines
+
+# (scheme, host:port) -> idle keep-alive connections
+_pool = {}  # type: dict[Tuple[str, str], List[http.client.HTTPConnection]]
+# (scheme, host:port) -> [seconds between requests, time of the next request]
+_limits = {}  # type: dict[Tuple[str, str], List[float]]
+_lock = threading.Lock()
 
 
 def _headers():
     return {"User-Agent": USER_AGENT,
             "Accept-Encoding": "gzip,deflate",
-            "Connection": "close"}
+            "Connection": "keep-alive"}
+
+
+def _connect(key):  # type: (Tuple[str, str]) -> http.client.HTTPConnection
+    while True:
+        with _lock:
+            conns = _pool.get(key)
+            if not conns:
+                break
+            conn = conns.pop()
+        if not select.select([conn.sock], [], [], 0)[0]:
+            return conn
+        conn.close()  # idle socket is readable only when the node closed it
+    if key[0] == "https":
+        return http.client.HTTPSConnection(key[1], timeout=TIMEOUT)
+    return http.client.HTTPConnection(key[1], timeout=TIMEOUT)
+
+
+def _release(key, conn):  # type: (Tuple[str, str], http.client.HTTPConnection) -> None
+    with _lock:
+        conns = _pool.setdefault(key, [])
+        if len(conns) < POOL_SIZE:
+            conns.append(conn)
+            return
+    conn.close()
+
+
+def nodeKey(url):  # type: (str) -> Tuple[str, str]
+    split = urllib.parse.urlsplit(url)
+    return split.scheme, split.netloc
+
+
+def setRateLimit(url, rate):  # type: (str, float) -> None
+    # requests per second to the node, 0 - no limit
+    with _lock:
+        if rate > 0:
+            _limits[nodeKey(url)] = [1 / rate, 0.0]
+        else:
+            _limits.pop(nodeKey(url), None)
+
 
+def _waitRateLimit(key):  # type: (Tuple[str, str]) -> None
+    with _lock:
+        limit = _limits.get(key)
+        if not limit:
+            return
+        now = time.monotonic()
+        at = max(now, limit[1])
+        limit[1] = at + limit[0]
+    if at > now:
+        time.sleep(at - now)
 
-def _doRequest(request):
-    if not request.headers:
-        request.headers = _headers()
-    with urllib.request.urlopen(request) as f:
-        data = f.read()
-        if f.info().get("Content-Encoding") in ("gzip", "deflate"):
-            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+def close():
+    with _lock:
+        conns = [c for cs in _pool.values() for c in cs]
+        _pool.clear()
+    for conn in conns:
+        conn.close()
+
+
+atexit.register(close)
+
+
+def _decode(data, encoding):  # type: (bytes, Optional[str]) -> str
+    if encoding in ("gzip", "deflate"):
+        data = zlib.decompress(data, 32 + zlib.MAX_WBITS)  # gzip or zlib
     return data.decode("utf-8")
 
 
+def _useProxy(url):  # type: (urllib.parse.SplitResult) -> bool
+    return (url.scheme in urllib.request.getproxies()
+            and not urllib.request.proxy_bypass(url.hostname or ""))
+
+
+def _urlopen(url, method, data, headers):
+    # proxy from the environment: leave it to urllib, without keep-alive
+    headers = dict(headers, Connection="close")
+    request = urllib.request.Request(url, data=data, method=method,
+                                     headers=headers)
+    resp = urllib.request.urlopen(request, timeout=TIMEOUT)
+    return resp, lambda ok: resp.close()
+
+
+def _send(key, method, path, data, headers):
+    # type: (Tuple[str, str], str, str, Optional[bytes], dict) -> Tuple[http.client.HTTPConnection, http.client.HTTPResponse]
+    while True:
+        conn = _connect(key)
+        reused = conn.sock is not None
+        try:
+            conn.request(method, path, body=data, headers=headers)
+            return conn, conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionError):
+            conn.close()
+            if not reused or method != "GET":
+                raise  # the node may have got the POST, don't send it twice
+            # node closed the idle connection, open a new one
+        except Exception:
+            conn.close()
+            raise
+
+
+def _done(key, conn, resp, ok):
+    if ok and not resp.will_close:
+        _release(key, conn)
+    else:
+        conn.close()
+
+
+def _open(url, method="GET", data=None):
+    # type: (str, str, Optional[bytes]) -> Tuple[http.client.HTTPResponse, Callable[[bool], None]]
+    # Response with the body not read yet and done(ok) to call after reading:
+    # it returns the connection to the pool if the body is read up to the end.
+    headers = _headers()
+    if data is not None:
+        headers["Content-Type"] = "application/x-www-form-urlencoded"
+    for _ in range(MAX_REDIRECTS + 1):
+        split = urllib.parse.urlsplit(url)
+        key = (split.scheme, split.netloc)
+        _waitRateLimit(key)
+        if _useProxy(split):
+            return _urlopen(url, method, data, headers)
+        path = urllib.parse.urlunsplit(("", "", split.path or "/", split.query, ""))
+        conn, resp = _send(key, method, path, data, headers)
+        if resp.status < 300:
+            return resp, functools.partial(_done, key, conn, resp)
+        try:
+            resp.read()
+        except Exception:
+            conn.close()
+            raise
+        _done(key, conn, resp, True)
+        location = resp.headers.get("Location")
+        if resp.status in (301, 302, 303, 307, 308) and location:
+            url = urllib.parse.urljoin(url, location)
+            if resp.status not in (307, 308):
+                method, data = "GET", None
+                headers.pop("Content-Type", None)
+        elif resp.status >= 400:
+            raise urllib.error.HTTPError(url, resp.status, resp.reason,
+                                         resp.headers, None)
+        else:
+            return resp, lambda ok: None
+    raise urllib.error.URLError("too many redirects: " + url)
+
+
+def _doRequest(url, method="GET", data=None):
+    # type: (str, str, Optional[bytes]) -> str
+    resp, done = _open(url, method, data)
+    try:
+        body = resp.read()
+    except Exception:
+        done(False)
+        raise
+    done(True)
+    return _decode(body, resp.headers.get("Content-Encoding"))
+
+
+def _iterLines(url, method="GET", data=None):
+    # type: (str, str, Optional[bytes]) -> Iterator[str]
+    # Response lines, decompressed and decoded chunk by chunk
+    # instead of holding the whole body in memory.
+    resp, done = _open(url, method, data)
+    ok = False
+    try:
+        inflate = None
+        if resp.headers.get("Content-Encoding") in ("gzip", "deflate"):
+            inflate = zlib.decompressobj(32 + zlib.MAX_WBITS)  # gzip or zlib
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        tail = ""
+        while True:
+            chunk = resp.read(CHUNK_SIZE)
+            final = not chunk
+            if inflate:
+                chunk = inflate.decompress(chunk) if chunk else inflate.flush()
+            lines = (tail + decoder.decode(chunk, final)).split("\n")
+            tail = lines.pop()
+            yield from lines
+            if final:
+                break
+        if tail:
+            yield tail
+        ok = True
+    finally:
+        done(ok)
+
+
 def getBundle(url, msgids):
-    req = urllib.request.Request(url + "u/m/" + msgids)
-    data = _doRequest(req).split("\n")
-    return list(filter(None, data))
+    return list(filter(None, _iterLines(url + "u/m/" + msgids)))
 
 
-def getMsgList(url, echoareas, offset=None, count=65535):
-    # type: (str, List[str], int, int) -> List[str]
+def iterMsgList(url, echoareas, offset=None, count=65535):
+    # type: (str, List[str], int, int) -> Iterator[str]
     if not echoareas:
-        return []
+        return
     x_filter = "/%s:%s" % (str(offset), str(count)) if offset else ""
 
     echoareas = "/".join(echoareas) + x_filter
-    req = urllib.request.Request(url + "u/e/" + echoareas, method="GET")
-    data = _doRequest(req)
-    data = data.split("\n")
-    return list(filter(None, data))
+    yield from filter(None, _iterLines(url + "u/e/" + echoareas))
+
+
+def getMsgList(url, echoareas, offset=None, count=65535):
+    # type: (str, List[str], int, int) -> List[str]
+    return list(iterMsgList(url, echoareas, offset, count))
 
 
 def sendMsg(url, auth, msg_b64):  # type: (str, str, str) -> str
     data = urllib.parse.urlencode({"tmsg": msg_b64, "pauth": auth}).encode("utf-8")
-    req = urllib.request.Request(url + "u/point", data=data, method="POST")
-    return _doRequest(req)
+    return _doRequest(url + "u/point", "POST", data)
 
 
 def getEchoCount(url, echoareas):  # type: (str, List[str]) -> dict[str, int]
     if not echoareas:
         return {}
     echoareas = "/".join(echoareas)
-    req = urllib.request.Request(url + "x/c/" + echoareas, method="GET")
-    data = _doRequest(req).split("\n")
+    data = _doRequest(url + "x/c/" + echoareas).split("\n")
     echoCounts = {it[0]: int(it[1])
                   for it in map(lambda it: it.split(":"),
                                 filter(None, data))}
@@ -66,8 +256,7 @@ def getEchoHash(url, echoareas):  # type: (str, List[str]) -> dict[str, str]
     if not echoareas:
         return {}
     echoareas = "/".join(echoareas)
-    req = urllib.request.Request(url + "x/h/" + echoareas, method="GET")
-    data = _doRequest(req).split("\n")
+    data = _doRequest(url + "x/h/" + echoareas).split("\n")
     echoHash = {it[0]: it[1]
                 for it in map(lambda it: it.split(":"),
                               filter(None, data))}
@@ -75,9 +264,8 @@ def getEchoHash(url, echoareas):  # type: (str, List[str]) -> dict[str, str]
 
 
 def getFeatures(url):  # type: (str) -> List[str]
-    req = urllib.request.Request(url + "x/features", method="GET")
     try:
-        data = _doRequest(req).split("\n")
+        data = _doRequest(url + "x/features").split("\n")
     except Exception as ex:
         return ["error: " + str(ex)]
     return list(filter(None, map(lambda it: it.strip(), data)))
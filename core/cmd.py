@@ -50,6 +50,7 @@ class Selector(metaclass=Group):
     END = Cmd("в конец")
     GET = Cmd("получить сообщения (свежие по счётчику)")
     FGET = Cmd("получить сообщения (полный индекс)")
+    GETALL = Cmd("получить сообщения со всех нод")
     ARCHIVE = Cmd("переключение в архив и обратно")
     ENTER = Cmd("открыть эху")
     OUT = Cmd("исходящие сообщения")
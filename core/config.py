@@ -54,6 +54,7 @@ class Node:
     echoareas: List[Echo] = dataclasses.field(default_factory=list)
     url: str = ""
     auth: str = ""
+    rateLimit: float = 0  # requests per second, 0 - no limit
     to: List[str] = dataclasses.field(default_factory=list)
     archive: List[Echo] = dataclasses.field(default_factory=list)
     stat: List[Echo] = dataclasses.field(default_factory=list)
@@ -72,6 +73,7 @@ class Config:
     db: str = "ait"
     keys: str = "default"
     twit: List[str] = dataclasses.field(default_factory=list)
+    searchWorkers: int = 0
 
     def node(self) -> Node:
         return self.nodes[self._node]
@@ -95,6 +97,7 @@ class Config:
         self.oldquote = False
         self.db = "ait"
         self.keys = "default"
+        self.searchWorkers = 0
         #
         node = None  # type: Optional[Node]
         shrink_spaces = re.compile(r"(\s\s+|\t+)")
@@ -114,6 +117,8 @@ class Config:
                     node.url += "/"
             elif param[0] == "auth":
                 node.auth = param[1]
+            elif param[0] == "ratelimit":
+                node.rateLimit = float(param[1])
             elif param[0] == "to":
                 node.to = " ".join(param[1:]).split(",")
             elif param[0] == "echo":
@@ -145,6 +150,8 @@ class Config:
                 self.twit = param[1].split(",")
             elif param[0] == "keys":
                 self.keys = param[1]
+            elif param[0] == "searchworkers":
+                self.searchWorkers = int(param[1])
             elif param[0] == "inlinestyle":
                 parser.INLINE_STYLE_ENABLED = True
             elif param[0] == "hscroll":
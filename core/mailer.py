@@ -1,23 +1,50 @@
+import asyncio
 import base64
 import codecs
-import itertools
+import concurrent.futures
+import functools
+import json
 import os
-import traceback
+import queue
+import threading
+import time
+from collections import deque
 from datetime import datetime
-from typing import List
+from typing import List, Iterable, Callable, Optional, Set, Tuple
 
 import api.ait
 from api import MsgMetadata
-from core import config, parser, client, FEAT_X_C, FEAT_U_E, utils
+from core import config, parser, client, aclient, FEAT_X_C, FEAT_X_H, FEAT_U_E, utils
 from core.config import CFG
 
 API = api.ait
 storage = ""
-blacklist = []
+IMPORT_SIZE = 10000  # fetch this many and the stored count or more with API.beginImport
+FETCH_THREADS = 4  # concurrent u/m/ requests
+BUNDLE_MIN = 20  # msgids per u/m/ request
+BUNDLE_MAX = 100  # keep u/m/ URL short enough for nodes
+BUNDLE_TIME = 2.0  # seconds per u/m/ request to grow or shrink bundles to
+JOURNAL = "fetch.journal"  # msgids of an unfinished getMail, in the node directory
+blacklist = set()
 if os.path.exists("blacklist.txt"):
     with open("blacklist.txt", "r") as bl:
-        blacklist = list(filter(None, map(lambda it: it.strip(),
-                                          bl.readlines())))
+        blacklist = set(filter(None, map(lambda it: it.strip(),
+                                         bl.readlines())))
+
+
+_sync = threading.local()  # storage and output of the background sync thread
+
+
+def report(text="", end="\n"):  # type: (str, str) -> None
+    onStatus = getattr(_sync, "onStatus", None)
+    if onStatus is None:
+        print(text, end=end)
+    elif text.strip():
+        onStatus(text.strip())
+
+
+def _api():
+    return getattr(_sync, "api", None) or API
 
 
 def init(cfg, storage_=""):
@@ -178,31 +205,45 @@ def sendMail(node):  # type: (config.Node) -> None
     nodeDir = directory(node)
     lst = [x for x in sorted(os.listdir(nodeDir))
            if x.endswith(".toss")]
-    total = str(len(lst))
-    try:
-        for n, msg in enumerate(lst, start=1):
-            print("\rОтправка сообщения: " + str(n) + "/" + total, end="")
-            msgToss = nodeDir + msg
-            with codecs.open(msgToss, "r", "utf-8") as f:
-                text = f.read()
-            #
-            result = client.sendMsg(node.url, node.auth, text)
-            #
-            if result.startswith("msg ok"):
-                os.remove(msgToss)
-            elif result == "msg big!":
-                print("\nERROR: very big message (limit 64K)!")
-            elif result == "auth error!":
-                print("\nERROR: unknown auth!")
-            else:
-                print("\nERROR: unknown error!")
-        if len(lst) > 0:
-            print()
-    except Exception as ex:
-        print("\nОшибка: не удаётся связаться с нодой. " + str(ex))
+    if lst:
+        texts = {}
+        for msg in lst:
+            with codecs.open(nodeDir + msg, "r", "utf-8") as f:
+                texts[msg] = f.read()
+        asyncio.run(_sendMail(node, nodeDir, texts))
+        report()
+
+
+async def _sendMail(node, nodeDir, texts):
+    # type: (config.Node, str, dict[str, str]) -> None
+    sent = 0
+
+    def onResult(msg, result):
+        nonlocal sent
+        sent += 1
+        report("\rОтправка сообщения: " + str(sent) + "/" + str(len(texts)), end="")
+        if result.startswith("msg ok"):
+            os.remove(nodeDir + msg)
+        elif result == "msg big!":
+            report("\nERROR: very big message (limit 64K)!")
+        elif result == "auth error!":
+            report("\nERROR: unknown auth!")
+        else:
+            report("\nERROR: unknown error!")
+
+    async def send(msg):
+        onResult(msg, await aclient.sendMsg(node.url, node.auth, texts[msg]))
 
+    # u/push is node-to-node (bundles of ready messages with msgids), the
+    # point messages go to u/point
+    results = await asyncio.gather(*map(send, texts), return_exceptions=True)
+    errors = [r for r in results if isinstance(r, Exception)]
+    if errors:
+        report("\nОшибка: не удаётся связаться с нодой. " + str(errors[0]))
 
-def debundle(bundle, getList=None):
+
+def debundle(bundle, getList=None, node=None):
+    node = node or CFG.node()
     messages = []
     for msg in filter(None, bundle):
         m = msg.split(":")
@@ -210,79 +251,328 @@ def debundle(bundle, getList=None):
         if len(msgid) == 20 and m[1]:
             msgbody = base64.b64decode(m[1].encode("ascii")).decode("utf8").split("\n")
             if getList and msgid not in getList:
-                print(f"\nWARNING:"
-                      f" msgid: {msgid} received but not requested: [{', '.join(getList)}]."
-                      f" Skipped. Please report to node sysop.")
+                report(f"\nWARNING:"
+                       f" msgid: {msgid} received but not requested: [{', '.join(getList)}]."
+                       f" Skipped. Please report to node sysop.")
             else:
                 messages.append([msgid, msgbody])
     if messages:
-        API.saveMessage(messages, CFG.node(), CFG.node().to)
-
+        _api().saveMessage(messages, node, node.to)
+        onSaved = getattr(_sync, "onSaved", None)
+        if onSaved:
+            onSaved({m[1][1] for m in messages})
+
+
+class StorageProxy:
+    # Storage API for the background sync thread: the calls are queued and
+    # run by the thread owning the storage (UI thread) in runPending().
+    def __init__(self, storageApi):
+        self.api = storageApi
+        self.owner = threading.get_ident()
+        self.calls = queue.Queue()
+
+    def __getattr__(self, name):
+        fn = getattr(self.api, name)
+        if not callable(fn):
+            return fn
+
+        def call(*args, **kwargs):
+            if threading.get_ident() == self.owner:
+                return fn(*args, **kwargs)
+            future = concurrent.futures.Future()
+            self.calls.put((future, fn, args, kwargs))
+            return future.result()
+        return call
+
+    def runPending(self):  # type: () -> bool
+        ran = False
+        while True:
+            try:
+                future, fn, args, kwargs = self.calls.get_nowait()
+            except queue.Empty:
+                return ran
+            ran = True
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as ex:
+                future.set_exception(ex)
+
+
+class SyncThread(threading.Thread):
+    # sendMail and getMail of the nodes at once, without the console: the
+    # status line goes to .status, the echoareas with saved messages to takeSaved()
+    def __init__(self, nodes, forceFullIdx=False):
+        # type: (List[config.Node], bool) -> None
+        super().__init__(daemon=True)
+        self.nodes = nodes
+        self.forceFullIdx = forceFullIdx
+        self.storage = StorageProxy(API)
+        self.status = ""
+        self.errors = {}  # type: dict[str, Exception]
+        self.done = 0
+        self._saved = set()
+        self._claimed = set()
+        self._lock = threading.Lock()
+
+    def run(self):
+        workers = [threading.Thread(target=self.syncNode, args=(node,), daemon=True)
+                   for node in self.nodes]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        if self.errors and len(self.nodes) > 1:
+            self.status = "ОШИБКА: " + ", ".join(self.errors)
+
+    def syncNode(self, node):  # type: (config.Node) -> None
+        _sync.api = self.storage
+        _sync.onStatus = functools.partial(self.setStatus, node)
+        _sync.onSaved = self.addSaved
+        _sync.claim = self.claim
+        try:
+            client.setRateLimit(node.url, node.rateLimit)
+            if node.auth:
+                makeToss(node)
+                sendMail(node)
+            getMail(node, self.forceFullIdx)
+        except Exception as ex:
+            self.errors[node.nodename] = ex
+            report("ОШИБКА: " + str(ex))
+        finally:
+            with self._lock:
+                self.done += 1
+
+    def setStatus(self, node, text):  # type: (config.Node, str) -> None
+        if len(self.nodes) > 1:
+            text = "[%d/%d] %s: %s" % (self.done, len(self.nodes),
+                                       node.nodename, text)
+        self.status = text
+
+    def addSaved(self, echoareas):
+        with self._lock:
+            self._saved |= echoareas
+
+    def takeSaved(self):  # type: () -> Set[str]
+        with self._lock:
+            saved, self._saved = self._saved, set()
+        return saved
+
+    def claim(self, msgids):  # type: (List[str]) -> List[str]
+        # msgids not fetched from other nodes by this sync
+        with self._lock:
+            msgids = [m for m in msgids if m not in self._claimed]
+            self._claimed.update(msgids)
+        return msgids
+
+    def runPending(self):  # type: () -> bool
+        return self.storage.runPending()
+
+
+def diffIndex(remoteMsgList, getEchoMsgids):
+    # type: (Iterable[str], Callable[[str], List[str]]) -> List[str]
+    fetchMsgList = []
+    localIndex = set()
+    for line in remoteMsgList:
+        if parser.echoTemplate.match(line):
+            localIndex = set(getEchoMsgids(line))
+        elif len(line) == 20 and line not in localIndex and line not in blacklist:
+            fetchMsgList.append(line)
+            localIndex.add(line)  # listed twice by node
+    return fetchMsgList
+
+
+def fetchBundles(url, fetchMsgList, onBundle, threads=FETCH_THREADS):
+    # type: (str, List[str], Callable[[List[str], List[str]], None], int) -> None
+    # Downloads bundles concurrently, onBundle(msgids, bundle) gets them
+    # in the fetchMsgList order on the calling thread (the only storage writer).
+    asyncio.run(_fetchBundles(url, fetchMsgList, onBundle, threads))
+
+
+async def _fetchBundles(url, fetchMsgList, onBundle, threads):
+    requests = asyncio.Semaphore(threads)
+    pending = deque()  # (msgids, task) in the fetchMsgList order
+    pos = 0
+    size = BUNDLE_MIN
+
+    async def fetch(msgids):
+        nonlocal size
+        async with requests:
+            start = time.monotonic()
+            bundle = await aclient.getBundle(url, "/".join(msgids))
+            elapsed = time.monotonic() - start
+        # bigger bundles for high latency, smaller for slow transfer
+        if elapsed < BUNDLE_TIME / 2 and len(msgids) >= size:
+            size = min(BUNDLE_MAX, size * 2)
+        elif elapsed > BUNDLE_TIME:
+            size = max(BUNDLE_MIN, size // 2)
+        return bundle
 
-def fetchMail(node, forceFullIdx=False):  # type: (config.Node, bool) -> None
-    print("Работа с " + node.url)
     try:
-        if node.auth:
-            makeToss(node)
-            sendMail(node)
-        getMail(node, forceFullIdx)
-    except KeyboardInterrupt:
-        print("\nПрервано пользователем")
-    except Exception as ex:
-        print("\nОШИБКА: " + str(ex))
-        print(traceback.format_exc())
-    input("Нажмите Enter для продолжения.")
+        while pos < len(fetchMsgList) or pending:
+            while pos < len(fetchMsgList) and len(pending) < threads * 2:
+                msgids = fetchMsgList[pos:pos + size]
+                pos += len(msgids)
+                pending.append((msgids, asyncio.ensure_future(fetch(msgids))))
+            msgids, task = pending.popleft()
+            onBundle(msgids, await task)
+    finally:
+        for _, task in pending:
+            task.cancel()
 
 
 def getMail(node, forceFullIdx=False):  # type: (config.Node, bool) -> None
-    features = API.getNodeFeatures(node.nodename)
+    db = _api()
+    journal = directory(node) + JOURNAL
+    if os.path.exists(journal):
+        if forceFullIdx:
+            os.remove(journal)  # the full index is diffed anyway
+        else:
+            resumeMail(node, journal)
+    features = db.getNodeFeatures(node.nodename)
     if features is None:
-        print("Запрос x/features...")
+        report("Запрос x/features...")
         features = client.getFeatures(node.url)
-        API.saveNodeFeatures(node.nodename, features)
-        print("  x/features: " + ", ".join(features))
+        db.saveNodeFeatures(node.nodename, features)
+        report("  x/features: " + ", ".join(features))
     isNodeSmart = FEAT_X_C in features and FEAT_U_E in features
     #
     echoareas = list(map(lambda e: e.name, filter(lambda e: e.sync,
                                                   node.echoareas)))
     oldNec = None
     newNec = None
+    newHashes = None
     offsets = None
     if isNodeSmart:
-        oldNec = API.getNodeEchoCounts(node.nodename)
-        newNec = client.getEchoCount(node.url, echoareas)
-        offsets = utils.offsetsEchoCount(oldNec or {}, newNec)
+        oldNec = db.getNodeEchoCounts(node.nodename)
+        oldHashes = db.getNodeEchoHashes(node.nodename)
+        if FEAT_X_H in features:
+            newHashes = client.getEchoHash(node.url, echoareas)
+        if oldNec and oldHashes and newHashes and not forceFullIdx:
+            # counts of the changed echoareas only
+            changed = [e for e in echoareas
+                       if e not in oldNec or e not in newHashes
+                       or oldHashes.get(e) != newHashes[e]]
+            newNec = {e: oldNec[e] for e in echoareas if e not in changed}
+            newNec.update(client.getEchoCount(node.url, changed))
+            offsets = utils.offsetsEchoHash(oldNec, newNec, oldHashes, newHashes)
+        else:
+            newNec = client.getEchoCount(node.url, echoareas)
+            offsets = utils.offsetsEchoCount(oldNec or {}, newNec)
 
-    fetchMsgList = []
     if isNodeSmart and oldNec and not forceFullIdx:
-        print("Получение свежего индекса от ноды...")
-        remoteMsgList = []
-        grouped = {offset: [ec[0] for ec in ec]
-                   for offset, ec in itertools.groupby(offsets.items(),
-                                                       lambda ec: ec[1])}
-        for offset, echoareas in grouped.items():
-            print("  offset %s: %s" % (str(offset), ", ".join(echoareas)))
-            remoteMsgList += client.getMsgList(node.url, echoareas, offset)
+        report("Получение свежего индекса от ноды...")
+        grouped = {}  # type: dict[int, List[str]]
+        for echo, offset in offsets.items():
+            grouped.setdefault(offset, []).append(echo)
+
+        def freshMsgList():
+            for offset, echoareas in grouped.items():
+                report("  offset %s: %s" % (str(offset), ", ".join(echoareas)))
+                yield from client.iterMsgList(node.url, echoareas, offset)
+        remoteMsgList = freshMsgList()
     else:
-        print("Получение полного индекса от ноды...")
-        remoteMsgList = client.getMsgList(node.url, echoareas)
-
-    print("Построение разностного индекса...")
-    localIndex = None
-    for line in remoteMsgList:
-        if parser.echoTemplate.match(line):
-            localIndex = API.getEchoMsgids(line)
-        elif len(line) == 20 and line not in localIndex and line not in blacklist:
-            fetchMsgList.append(line)
+        report("Получение полного индекса от ноды...")
+        remoteMsgList = client.iterMsgList(node.url, echoareas)
+
+    report("Построение разностного индекса...")
+    fetchMsgList = diffIndex(remoteMsgList, db.getEchoMsgids)
+    claim = getattr(_sync, "claim", None)
+    if claim:
+        fetchMsgList = claim(fetchMsgList)
+    echoState = {"counts": newNec if isNodeSmart else None, "hashes": newHashes}
     if fetchMsgList:
-        total = str(len(fetchMsgList))
-        count = 0
-        for getList in utils.separate(fetchMsgList):
-            count += len(getList)
-            print("\rПолучение сообщений: " + str(count) + "/" + total, end="")
-            debundle(client.getBundle(node.url, "/".join(getList)), getList)
+        _writeJournal(journal, echoState, fetchMsgList)
+        fetchMsgs(node, fetchMsgList, journal)
     else:
-        print("Новых сообщений не обнаружено.", end="")
-    if isNodeSmart:
-        API.saveNodeEchoCounts(node.nodename, newNec)
-    print()
+        report("Новых сообщений не обнаружено.", end="")
+    _saveEchoState(node, echoState)
+    if os.path.exists(journal):
+        os.remove(journal)
+    report()
+
+
+def fetchMsgs(node, fetchMsgList, journal):
+    # type: (config.Node, List[str], str) -> None
+    db = _api()
+    total = str(len(fetchMsgList))
+    count = 0
+    isImport = len(fetchMsgList) >= max(IMPORT_SIZE, _localSize(node))
+    if isImport:
+        db.beginImport()
+
+    with open(journal, "a", encoding="utf-8") as j:
+        def onBundle(getList, bundle):
+            nonlocal count
+            count += len(getList)
+            report("\rПолучение сообщений: " + str(count) + "/" + total, end="")
+            debundle(bundle, getList, node)
+            j.write("+%d\n" % len(getList))
+            j.flush()
+
+        try:
+            fetchBundles(node.url, fetchMsgList, onBundle)
+        finally:
+            if isImport:
+                report("\nПостроение индексов...", end="")
+                db.endImport()
+
+
+def _localSize(node):  # type: (config.Node) -> int
+    db = _api()
+    echoes = {echo.name for nd in [node] + CFG.nodes
+              for echo in nd.echoareas + nd.archive}
+    return sum(db.getEchoLength(echo) for echo in echoes)
+
+
+def _saveEchoState(node, echoState):  # type: (config.Node, dict) -> None
+    db = _api()
+    if echoState["counts"] is not None:
+        db.saveNodeEchoCounts(node.nodename, echoState["counts"])
+    if echoState["hashes"] is not None:
+        db.saveNodeEchoHashes(node.nodename, echoState["hashes"])
+
+
+# Fetch journal of the node: echo state to save after the fetch (json),
+# msgids to fetch, "=" and "+N" after every N msgids saved, in order.
+def _writeJournal(path, echoState, msgids):
+    # type: (str, dict, List[str]) -> None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(json.dumps(echoState) + "\n")
+        f.writelines(m + "\n" for m in msgids)
+        f.write("=\n")
+    os.replace(path + ".tmp", path)
+
+
+def _readJournal(path):  # type: (str) -> Optional[Tuple[dict, List[str]]]
+    with open(path, "r", encoding="utf-8") as f:
+        lines = f.read().split("\n")
+    try:
+        echoState = json.loads(lines[0])
+        end = lines.index("=")
+    except ValueError:
+        return None  # broken journal
+    done = sum(int(line[1:]) for line in lines[end + 1:]
+               if line[:1] == "+" and line[1:].isdigit())
+    return echoState, lines[1:end][done:]
+
+
+def resumeMail(node, journal):  # type: (config.Node, str) -> None
+    resumed = _readJournal(journal)
+    if resumed:
+        echoState, pending = resumed
+        report("Продолжение прерванного получения сообщений...")
+        # the last bundle could be saved without the journal record
+        db = _api()
+        local = set()
+        for echo in node.echoareas:
+            local.update(db.getEchoMsgids(echo.name))
+        pending = [m for m in pending if m not in local]
+        claim = getattr(_sync, "claim", None)
+        if claim:
+            pending = claim(pending)
+        if pending:
+            fetchMsgs(node, pending, journal)
+            report()
+        _saveEchoState(node, echoState)
+    os.remove(journal)
@@ -5,7 +5,7 @@ import sys
 from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum, auto
-from typing import List, Optional, Tuple
+from typing import Callable, List, Optional, Tuple, Union
 
 from core import utils
 
@@ -135,11 +135,17 @@ def isCodeBlock2(line):
 
 
 def tokenize(lines: List[str], startLine=0, inCodeBlock=False, endLine=0) -> List[Token]:
+    return tokenizeChunk(lines, startLine, inCodeBlock, endLine)[0]
+
+
+def tokenizeChunk(lines, startLine=0, inCodeBlock=False, endLine=0):
+    # type: (List[str], int, Union[bool, Callable], int) -> Tuple[List[Token], int, Union[bool, Callable]]
+    """:return: tokens, line number and code block state to continue with"""
     tokens = []
     lineNum = startLine
     while lineNum - startLine < len(lines):
-        if startLine < endLine and lineNum == endLine:
-            return tokens  #
+        if startLine < endLine <= lineNum:
+            return tokens, lineNum, inCodeBlock  #
         line = lines[lineNum - startLine]
         #
         if not inCodeBlock:
@@ -266,7 +272,7 @@ def tokenize(lines: List[str], startLine=0, inCodeBlock=False, endLine=0) -> Lis
             tokens.extend(_inline(line, lineNum, Token(TT.TEXT, "", lineNum)))
         lineNum += 1
 
-    return tokens
+    return tokens, lineNum, inCodeBlock
 
 
 def _inline(text: str, lineNum: int, token: Token) -> List[Token]:
@@ -1,5 +1,6 @@
 import base64
 import curses
+import dataclasses
 import hashlib
 import json
 import os
@@ -7,15 +8,16 @@ import pickle
 import re
 import subprocess
 import textwrap
+import threading
 import time
 import sys
 from abc import ABC
-from collections import deque
+from collections import deque, OrderedDict
 from datetime import datetime
 from enum import Enum
 from itertools import cycle
 from shutil import copyfile
-from typing import Optional, List, Tuple, TypeVar, Generic, Union, Callable
+from typing import Optional, List, Tuple, TypeVar, Generic, Union, Callable, Set
 
 import api.ait
 from api import MsgMetadata, FindQuery
@@ -39,6 +41,16 @@ LABEL_ANY_KEY = "Нажмите любую клавишу"
 LABEL_FIND = "Поиск "  # extra space for wide unicode icon (use wcwidth)
 
 stdscr = None  # type: Optional[curses.window]
+SYNC_POLL = 20  # ms, UI thread runs the storage calls of the background sync
+SYNC_REDRAW = 500  # ms, echo selector redraws counts while syncing
+RESIZE_DELAY = 50  # ms, resize events coming closer are rendered once
+MSG_CACHE = 64  # read and prerendered messages kept by the reader
+LAZY_LINES = 300  # longer bodies are tokenized by chunks of that many lines
+PREFETCH = 3  # next and previous messages prerendered ahead
+REGEX_CHARS = set(".^$*+?{}[]\\|()")  # quick search narrows literal queries only
+sync = None  # type: Optional[mailer.SyncThread]
+onSyncSaved = None  # type: Optional[Callable[[Set[str], bool], None]]
+statusBar = None  # [scr, sync status column, sync status drawn]
 version = "Caesium/%s │" % __version__
 
 
@@ -117,13 +129,72 @@ def initKeys():
             setattr(keystroke.Keys, name, getattr(cmd.Common, name).ks)
 
 
-def getKeystroke(timeout=-1):
+def runSync():
+    # on the UI thread: storage calls of the background sync, its status
+    global onSyncSaved
+    if not sync:
+        return
+    sync.runPending()
+    finished = not sync.is_alive()
+    saved = sync.takeSaved()
+    if onSyncSaved and (saved or finished):
+        onSyncSaved(saved, finished)
+        if finished:
+            onSyncSaved = None  # the final update is done once
+    if statusBar and statusBar[2] != sync.status:
+        drawSyncStatus(statusBar[0], statusBar[1])
+        statusBar[0].refresh()
+
+
+def _getch(timeout):  # type: (int) -> int
+    deadline = time.monotonic() + timeout / 1000 if timeout >= 0 else None
+    while sync and sync.is_alive():
+        runSync()
+        wait = SYNC_POLL
+        if deadline is not None:
+            wait = max(0, min(wait, int((deadline - time.monotonic()) * 1000)))
+        stdscr.timeout(wait)
+        key = stdscr.getch()
+        if key != -1 or (deadline is not None and time.monotonic() >= deadline):
+            return key
+    runSync()
+    if deadline is not None:
+        timeout = max(0, int((deadline - time.monotonic()) * 1000))
     stdscr.timeout(timeout)
+    return stdscr.getch()
+
+
+def _skipResizes():
+    # resize storm (dragging the terminal edge): render the last size only
+    pending = keystroke.PENDING_KEYS
+    while True:
+        while pending and pending[0] == curses.KEY_RESIZE:
+            pending.pop(0)
+        if pending:
+            return  # a key pressed meanwhile is handled after the resize
+        stdscr.timeout(RESIZE_DELAY)
+        ch = keystroke.getWch(stdscr)
+        stdscr.timeout(0)
+        while ch != -1:
+            pending.append(ch)
+            if ch == curses.KEY_MOUSE:
+                pending.append(curses.getmouse())
+            ch = keystroke.getWch(stdscr)
+        if not pending:
+            return
+
+
+def getKeystroke(timeout=-1):
+    global sync
     key = -1
     if not keystroke.PENDING_KEYS:
-        key = stdscr.getch()
+        key = _getch(timeout)
+    if key != -1 and sync and not sync.is_alive():
+        sync = None  # last status shown until a key is pressed
     stdscr.timeout(0)
     ks, key, _ = keystroke.getkeystroke(stdscr, key)
+    if key == curses.KEY_RESIZE:
+        _skipResizes()
     stdscr.timeout(-1)
     if ks == "C-c" or ks in Common.QUIT:
         sys.exit(0)
@@ -221,6 +292,7 @@ def drawStatusBar(scr, mode=None, text=None):
     scr.addstr(h - 1, w - 8, "│ " + datetime.now().strftime("%H:%M"), color)
     if text:
         scr.addstr(h - 1, len(version) + 2, text, color)
+    drawSyncStatus(scr, len(version) + 3 + len(text or ""))
     if mode:
         scr.addstr(h - 1, w - 11, mode.value, color)
     if parser.INLINE_STYLE_ENABLED:
@@ -229,6 +301,22 @@ def drawStatusBar(scr, mode=None, text=None):
                color)
 
 
+def drawSyncStatus(scr, left):  # type: (curses.window, int) -> None
+    # background sync status, right-aligned in the free part of the status bar
+    global statusBar
+    h, w = scr.getmaxyx()
+    status = sync.status if sync else ""
+    statusBar = [scr, left, status]
+    right = w - 12
+    if right - left < 4:
+        return
+    scr.addstr(h - 1, left, " " * (right - left), getColor(UI_STATUS))
+    if status:
+        status = status[-(right - left - 2):]
+        scr.addstr(h - 1, right - len(status) - 1, status,
+                   getColor(UI_STATUS) | curses.A_BOLD)
+
+
 def drawReader(scr, echo: str, msgid, out):
     h, w = scr.getmaxyx()
     color = getColor(UI_BORDER)
@@ -482,6 +570,28 @@ class ModeStackABC(ABC, Generic[T, V]):
 
 
 class MsgModeStack(ModeStackABC[ReaderMode, MsgMetadata]):
+    twitMask = None  # type: Optional[List[bool]]  # data items by CFG.twit
+
+    @property
+    def data(self):  # type: () -> List[MsgMetadata]
+        return self._data
+
+    @data.setter
+    def data(self, data):  # type: (List[MsgMetadata]) -> None
+        self._data = data
+        self.twitMask = None
+
+    def isTwit(self, idx):  # type: (int) -> bool
+        if not 0 <= idx < len(self.data):
+            return False
+        if self.twitMask is None:
+            self.twitMask = []
+        if idx >= len(self.twitMask):  # new list or found messages appended
+            twit = set(CFG.twit)
+            self.twitMask.extend(m.fr in twit or m.to in twit
+                                 for m in self.data[len(self.twitMask):])
+        return self.twitMask[idx]
+
     def modeSubjOn(self, data):
         data = sorted(data, key=lambda m: m.time)
         self.push(ReaderMode.SUBJ, data)
@@ -623,8 +733,8 @@ class MsgListScreen(Window):
             win.addstr(i, 16, msg.subj[:self.w - 27], color)
             win.addstr(i, self.w - 11, msg.strtime(), color)
             #
-            if self.qs and pos in self.qs.result:
-                idx = self.qs.result.index(pos)
+            idx = self.qs.byPos.get(pos) if self.qs else None
+            if idx is not None:
                 mName, mSubj = self.qs.matches[idx]  # type: List[re.Match], List[re.Match]
                 for m in mName:
                     win.addstr(i, 0 + m.start(), msg.fr[m.start():m.end()],
@@ -694,6 +804,40 @@ class MsgListScreen(Window):
             self.qs.onResize(self.w - len(version) - 13)
 
 
+class FindStream:
+    # Search in a thread, found messages are appended to data as they come
+    def __init__(self, query: FindQuery):
+        self.data = []  # type: List[MsgMetadata]
+        self.progress = None
+        self.cancel = False
+        self.done = False
+        self.error = None  # type: Optional[Exception]
+        self.thread = threading.Thread(target=self._run, args=(query,),
+                                       daemon=True)
+        self.thread.start()
+
+    def _run(self, query):
+        try:
+            for m in API.iterQueryMsgids(query, self._progress):
+                self.data.append(m)
+        except Exception as ex:
+            self.error = ex
+        finally:
+            self.done = True
+
+    def _progress(self, param):
+        self.progress = param
+        return API.FIND_CANCEL if self.cancel else API.FIND_OK
+
+    def stop(self):
+        self.cancel = True
+        self.thread.join()
+
+    def check(self):
+        if self.error:
+            raise self.error
+
+
 class FindQueryWindow(Window):
     layout: GridLayout = None
     query = FindQuery()
@@ -706,6 +850,7 @@ class FindQueryWindow(Window):
     findCancel: bool = False
     findResult: List[MsgMetadata] = None
     findTick: float = 0
+    stream: FindStream = None
 
     def __init__(self, scr, cfg: Config):
         super().__init__(scr)
@@ -841,9 +986,9 @@ class FindQueryWindow(Window):
         self.drawContent(self.win)
         self.win.refresh()
 
-    def _keys(self):
+    def _keys(self, timeout=0):
         if self.findInProgress:
-            ks, key, _ = getKeystroke(0)
+            ks, key, _ = getKeystroke(timeout)
         else:
             ks, key, _ = getKeystroke()
         self.go = self.onKeyPressed(ks, key)
@@ -982,14 +1127,22 @@ class FindQueryWindow(Window):
             for node in self.cfg.nodes:
                 arch += list(map(lambda e: e.name, node.archive + node.stat))
             self.query.echoArch = " ".join(arch)
-
-        self.findResult = API.findQueryMsgids(
-            self.query, progressHandler=self._findProgressHandler)
+        self.query.workers = self.cfg.searchWorkers
+
+        # wait for the first found messages only, the rest come to the reader
+        self.stream = FindStream(dataclasses.replace(self.query))
+        while not self.stream.data and not self.stream.done:
+            # waits for a key running the sync storage calls, see _getch
+            if self._findProgressHandler(self.stream.progress, 50) == API.FIND_CANCEL:
+                self.stream.stop()
+                break
+        self.stream.check()
+        self.findResult = [] if self.stream.cancel else self.stream.data
         self.findInProgress = False
 
-    def _findProgressHandler(self, param=None):
+    def _findProgressHandler(self, param=None, timeout=0):
         now = time.time()
-        self._keys()
+        self._keys(timeout)
         if self.findCancel:
             return API.FIND_CANCEL
         if (now - self.findTick) < 0.250:  # ms
@@ -1023,6 +1176,10 @@ class Pager:
         pass
 
 
+def isLiteral(query):  # type: (str) -> bool
+    return not any(c in REGEX_CHARS for c in query)
+
+
 def newQuickSearch(items, matcher):
     h, w = stdscr.getmaxyx()
     stdscr.move(h - 1, len(version) + 2)
@@ -1039,23 +1196,34 @@ class QuickSearch(InputRegexWidget):
         self.items = items
         self.matches = []
         self.result = []
+        self.byPos = {}  # item idx -> idx of its first match in the result
         self.idx = 0
         self.matcher = matcher
+        self.query = ""  # query of the result
         self.color = getColor(color)
         self.statTxt = ""
         self.statPos = 0
 
     def draw(self, win):
         # type: (curses.window) -> None
+        global statusBar
+        statusBar = None  # the input covers the sync status
         super().draw(win)
         if self.txt and not self.err:
             win.addstr(self.y, self.x + self.statPos, self.statTxt, self.color)
         win.move(self.y, self.x + self.getWinCursorPos())
 
     def search(self, query, pos):
+        # the literal query extending the previous one can only match
+        # the items matched already
+        narrow = (self.query and self.query in query
+                  and isLiteral(self.query) and isLiteral(query))
+        candidates = list(self.byPos) if narrow else range(len(self.items))
         self.result = []
         self.matches = []
+        self.byPos = {}
         self.idx = -1
+        self.query = ""
 
         if self.txt != query:
             self.txt = query
@@ -1063,9 +1231,11 @@ class QuickSearch(InputRegexWidget):
         if not (query and self.template):
             return  #
 
+        self.query = query
         sidx = 0
-        for i, item in enumerate(self.items):
-            if matches := self.matcher(sidx, self.template, item):
+        for i in candidates:
+            if matches := self.matcher(sidx, self.template, self.items[i]):
+                self.byPos[i] = len(self.result)
                 for m in matches:
                     self.result.append(i)
                     self.matches.append(m)
@@ -1162,6 +1332,179 @@ class QuickSearch(InputRegexWidget):
 
 
 # region EchoReader
+class MsgRender:
+    # Message body tokens prerendered for the width. A long body is
+    # tokenized and wrapped by chunks of lines as the reader scrolls to them.
+    def __init__(self, msg, w, h):  # type: (List[str], int, int) -> None
+        self.msg = msg
+        self.body = msg[8:]
+        self.inline = parser.INLINE_STYLE_ENABLED  # tokens depend on it
+        self.wrapKey = (w, h, parser.HORIZONTAL_SCROLL_ENABLED)
+        self.lazy = len(self.body) > LAZY_LINES
+        self.w = w
+        self.tokens = []  # type: List[parser.Token]
+        self.t2l = []  # type: List[parser.RangeLines]
+        self.height = 0
+        self.maxWidth = w
+        self.hScroll = False
+        self.line = 0  # next body line to tokenize
+        self.inCode = False  # code block state at the line
+        if not self.lazy:
+            self.tokens = parser.tokenize(self.body)
+            self.line = len(self.body)
+            self._wrap(w, h)
+
+    @property
+    def done(self):
+        return self.line >= len(self.body)
+
+    def estimate(self):  # type: () -> int
+        # rendered lines and the rest of the body at the same rate
+        if self.done or not self.line:
+            return max(self.height, len(self.body) - self.line)
+        return self.height + (len(self.body) - self.line) * self.height // self.line
+
+    def extendTo(self, y=None):  # type: (Optional[int]) -> bool
+        extended = False
+        while not self.done and (y is None or self.height < y):
+            tokens, self.line, self.inCode = parser.tokenizeChunk(
+                self.body[self.line:], self.line, self.inCode,
+                self.line + LAZY_LINES)
+            # long body is scrollable, reserve the scrollbar width
+            height, maxWidth, hScroll = parser.prerender(tokens, self.w - 1)
+            self.tokens.extend(tokens)
+            self.height += height
+            self.maxWidth = max(self.maxWidth, maxWidth)
+            self.hScroll = self.hScroll or hScroll
+            extended = True
+        if extended:
+            self.t2l = parser.tokenLineMap(self.tokens)
+        return extended
+
+    def rewrap(self, w, h):  # type: (int, int) -> bool
+        wrapKey = (w, h, parser.HORIZONTAL_SCROLL_ENABLED)
+        if wrapKey == self.wrapKey:
+            return False
+        self.wrapKey = wrapKey
+        self._wrap(w, h)
+        return True
+
+    def _wrap(self, w, h):
+        self.w = w
+        if not self.lazy:
+            self.height, self.maxWidth, self.hScroll = parser.prerender(
+                self.tokens, w, h)
+        elif self.tokens:
+            height, maxWidth, self.hScroll = parser.prerender(self.tokens, w - 1)
+            self.height, self.maxWidth = height, max(w, maxWidth)
+        else:
+            self.height, self.maxWidth, self.hScroll = 0, w, False
+        self.t2l = parser.tokenLineMap(self.tokens)
+
+
+def renderMsg(msg, w, h, rendered=None):
+    # type: (List[str], int, int, Optional[MsgRender]) -> MsgRender
+    # tokens of the same message are kept, re-wrapped for the new size only
+    if (rendered and rendered.msg is msg
+            and rendered.inline == parser.INLINE_STYLE_ENABLED):
+        rendered.rewrap(w, h)
+        return rendered
+    rendered = MsgRender(msg, w, h)
+    rendered.extendTo(h)
+    return rendered
+
+
+class MsgCache:
+    # LRU of the read and prerendered messages, a thread fills it ahead
+    # with the messages around the current one
+    def __init__(self, size=MSG_CACHE):
+        self.size = size
+        self.items = OrderedDict()  # type: OrderedDict[str, list]  # msgid -> [msg, size, rendered]
+        self.lock = threading.Condition()
+        self.todo = []  # type: List[Tuple[str, str]]
+        self.wh = (0, 0)
+        self.thread = None  # type: Optional[threading.Thread]
+        self.stopped = False
+
+    def _get(self, msgid):
+        with self.lock:
+            item = self.items.get(msgid)
+            if item:
+                self.items.move_to_end(msgid)
+            return item
+
+    def _put(self, msgid, msg, size, rendered=None):
+        with self.lock:
+            self.items[msgid] = [msg, size, rendered]
+            self.items.move_to_end(msgid)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def _rendered(self, msgid):  # type: (str) -> bool
+        # tokens of the message are cached, maybe wrapped for other size
+        item = self.items.get(msgid)
+        return bool(item and item[2]
+                    and item[2].inline == parser.INLINE_STYLE_ENABLED)
+
+    def read(self, msgid, echo):  # type: (str, str) -> Tuple[List[str], int]
+        item = self._get(msgid)
+        if item:
+            return item[0], item[1]
+        msg, size = API.readMsg(msgid, echo)
+        if size:  # missing message may come with the next sync
+            self._put(msgid, msg, size)
+        return msg, size
+
+    def render(self, msgid, msg, w, h):  # type: (str, List[str], int, int) -> MsgRender
+        item = self._get(msgid)
+        rendered = renderMsg(msg, w, h, item[2] if item else None)
+        if item and item[2] is not rendered:
+            self._put(msgid, item[0], item[1], rendered)
+        return rendered
+
+    def _prerender(self, msgid, msg, w, h):
+        # new render only: the reader may wrap the cached one meanwhile
+        rendered = renderMsg(msg, w, h)
+        with self.lock:
+            item = self.items.get(msgid)
+            if (item and item[0] is msg and not self._rendered(msgid)
+                    and rendered.inline == parser.INLINE_STYLE_ENABLED):
+                item[2] = rendered
+
+    def prefetch(self, msgs, w, h):  # type: (List[MsgMetadata], int, int) -> None
+        with self.lock:
+            self.todo = [(m.msgid, m.echo) for m in msgs
+                         if not self._rendered(m.msgid)]
+            self.wh = (w, h)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.lock.notify()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.todo and not self.stopped:
+                    self.lock.wait()
+                if self.stopped:
+                    return
+                msgid, echo = self.todo.pop(0)
+                w, h = self.wh
+            try:
+                msg, size = self.read(msgid, echo)
+                if size:
+                    self._prerender(msgid, msg, w, h)
+            except Exception:
+                pass  # the reader reads it again and shows the error
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.lock.notify()
+        if self.thread:
+            self.thread.join()
+
+
 class ReaderWidget(Widget):
     tokens: List[parser.Token]  # message bode tokens
     scrollV: ScrollCalc = None  # message body scroll calculator (vertical)
@@ -1170,6 +1513,9 @@ class ReaderWidget(Widget):
     #
     msg: List[str] = None
     size: int = 0
+    msgid: Optional[str] = None  # message from the storage, cached
+    cache: Optional[MsgCache] = None
+    rendered: MsgRender = None
 
     def __init__(self):
         self.msg = ["", "", "", "", "", "", "", "", "Сообщение отсутствует в базе"]
@@ -1184,20 +1530,35 @@ class ReaderWidget(Widget):
         if h is not None:
             self.h = h
 
-    def setMsg(self, msg, size):
+    def setMsg(self, msg, size, msgid=None):
         self.msg = msg
         self.size = size
+        self.msgid = msgid
 
     def prerender(self, pos=0):
-        self.tokens = parser.tokenize(self.msg[8:])
-        height, maxWidth, hScroll = parser.prerender(self.tokens, self.w, self.h)
-        self.t2l = parser.tokenLineMap(self.tokens)
+        if self.cache and self.msgid:
+            self.rendered = self.cache.render(self.msgid, self.msg, self.w, self.h)
+        else:
+            self.rendered = renderMsg(self.msg, self.w, self.h, self.rendered)
+        self.rendered.extendTo(pos + 2 * self.h)
+        self.tokens = self.rendered.tokens
+        self.updateScroll(pos, 0)
+
+    def updateScroll(self, pos, posH):
+        r = self.rendered
+        self.t2l = r.t2l
         self.scrollV = ScrollCalc(
-            height, self.h - (1 if hScroll else 0), pos)
+            r.estimate(), self.h - (1 if r.hScroll else 0), pos)
         self.scrollH = ScrollCalc(
-            maxWidth, self.w - (1 if self.scrollV.isScrollable else 0), 0)
+            r.maxWidth, self.w - (1 if self.scrollV.isScrollable else 0), posH)
+
+    def renderTo(self, y=None):  # type: (Optional[int]) -> None
+        # the long message up to the line (or the whole)
+        if self.rendered.extendTo(y):
+            self.updateScroll(self.scrollV.pos, self.scrollH.pos)
 
     def draw(self, scr, qs=None):
+        self.renderTo(self.scrollV.pos + 2 * self.scrollV.view)
         self.renderBody(scr, self.tokens, self.scrollV.pos, self.scrollH.pos, qs)
         if self.scrollV.isScrollable:
             drawScrollBarV(scr, self.y, self.x + self.w - 1, self.scrollV)
@@ -1320,6 +1681,7 @@ class ReaderWidget(Widget):
         elif ks in Reader.RIGHTP:
             self.scrollH.pos += self.scrollH.view
         elif ks in Reader.MEND:
+            self.renderTo()
             self.scrollV.pos = self.scrollV.content - self.scrollV.view
         else:
             return False  # not handled
@@ -1426,12 +1788,14 @@ class EchoReaderScreen(Window):
     done: bool = False  # close app
     nextEcho: Union[str, bool] = False  # jump to next echo after reader closed
     resized: bool = False
+    stream: Optional[FindStream] = None  # search still fills msgids
 
     def __init__(self, scr: curses.window,
                  echo: config.Echo, msgn, archive, counts,
-                 mode=ReaderMode.ECHO, msgids=None):
+                 mode=ReaderMode.ECHO, msgids=None, stream=None):
         super().__init__(scr)
         self.echo = echo
+        self.stream = stream
         self.msgs = MsgModeStack(mode, msgids, msgn)
         self.archive = archive
         self.counts = counts
@@ -1450,6 +1814,7 @@ class EchoReaderScreen(Window):
         #
         self.reader = ReaderWidget()
         self.reader.setRect(x=0, y=5, w=self.w, h=self.h - 5 - 1)
+        self.reader.cache = MsgCache()
         #
         self.msgs.idx = min(msgn, len(self.msgs.data) - 1)
         if self.msgs.data:
@@ -1457,6 +1822,26 @@ class EchoReaderScreen(Window):
             if self.msgs.idx < 0:
                 self.nextEcho = True
         self.reader.prerender()
+        if self.stream and self.stream.done:
+            self.findDone()
+
+    def findDone(self):
+        # sort found messages by time, keep the current ones
+        data = self.stream.data
+        self.stream.check()
+        self.stream = None
+        stack = self.msgs.stack
+        items = [d[i] if d is data and 0 <= i < len(d) else None
+                 for _, d, i in stack]
+        cur = self.msgs.curItem() if self.msgs.data is data else None
+        data.sort(key=lambda m: m.time)
+        self.msgs.twitMask = None
+        if cur:
+            self.msgs.idx = self.msgs.findItemIdx(cur)
+            self.stack.clear()
+        for n, it in enumerate(items):
+            if it:
+                stack[n] = (stack[n][0], data, self.msgs.findItemIdx(it, data))
 
     def msgid(self):
         m = self.msgs.curItem()
@@ -1480,17 +1865,32 @@ class EchoReaderScreen(Window):
                 self.msgs.idx = 0
                 m = self.msgs.curItem()
             if m:
-                self.reader.setMsg(*API.readMsg(self._msgid or m.msgid, m.echo))
+                self.reader.setMsg(*self.reader.cache.read(m.msgid, m.echo),
+                                   msgid=m.msgid)
             else:
                 self.reader.setMsg(*API.readMsg("unknown", "unknown"))
 
     def readMsgSkipTwit(self, increment):
+        # twits are skipped by the metadata, the shown message is read only
+        msgs = self.msgs
+        if msgs.idx < 0 and msgs.data:
+            msgs.idx = 0
+        while (msgs.isTwit(msgs.idx)
+               and 0 <= msgs.idx + increment < len(msgs.data)):
+            msgs.idx += increment
         self.readCurMsg()
-        while self.reader.msg[3] in CFG.twit or self.reader.msg[5] in CFG.twit:
-            self.msgs.idx += increment
-            if self.msgs.idx < 0 or len(self.msgs.data) <= self.msgs.idx:
-                break
-            self.readCurMsg()
+        if msgs.isTwit(msgs.idx):
+            msgs.idx += increment  # nothing but twits left
+
+    def prefetch(self):
+        if self.out or not self.msgs.data:
+            return  # drafts and outgoing are edited, not cached
+        data, idx = self.msgs.data, self.msgs.idx
+        around = []
+        for i in range(1, PREFETCH + 1):
+            around.extend(data[n] for n in (idx + i, idx - i)
+                          if 0 <= n < len(data) and not self.msgs.isTwit(n))
+        self.reader.cache.prefetch(around, self.reader.w, self.reader.h)
 
     def reloadMsgsOrQuit(self):
         self.msgs.data = self.getMsgsMetadata()
@@ -1524,6 +1924,7 @@ class EchoReaderScreen(Window):
             if token.filedata:
                 saveAttachment(token)
         elif link.startswith("#"):  # markdown anchor?
+            self.reader.renderTo()
             pos = parser.findAnchorPos(self.reader.tokens, token)
             if pos != -1:
                 self.reader.scrollV.pos = pos
@@ -1581,6 +1982,10 @@ class EchoReaderScreen(Window):
                 self._show(self.msgs, self.reader)
         except SystemExit:
             self.done = True
+        finally:
+            self.reader.cache.stop()
+            if self.stream:
+                self.stream.stop()
 
         if self.msgs.mode == ReaderMode.ECHO:
             self.counts.lasts[self.echo.name] = self.msgs.idx
@@ -1590,24 +1995,37 @@ class EchoReaderScreen(Window):
         return not self.done, self.nextEcho
 
     def _show(self, msgs: MsgModeStack, reader: ReaderWidget):
+        if self.stream and self.stream.done:
+            self.findDone()
         self.scr.clear()
         status = None
         if msgs.data:
             self.draw(self.scr)
             status = utils.msgnStatus(len(msgs.data), msgs.idx, self.w)
+            if self.stream:
+                status += " (поиск" + THEME.ellipsis + ")"
         else:
             drawReader(self.scr, self.echo.name, "", self.out)
         drawStatusBar(self.scr, mode=msgs.mode, text=status)
         if self.qs:
             self.qs.draw(self.scr)
+        self.prefetch()
         #
-        ks, key, _ = getKeystroke()
+        ks, key, _ = getKeystroke(
+            0 if not reader.rendered.done else 250 if self.stream else -1)
+        while not ks and not key and not reader.rendered.done:
+            # the rest of the long message while waiting for a key
+            reader.renderTo(reader.rendered.height + 1)
+            ks, key, _ = getKeystroke(0)
         #
-        if key == curses.KEY_RESIZE:
+        if not ks and not key:
+            return  # redraw the found messages count, exact scroll height
+        elif key == curses.KEY_RESIZE:
             self.onResize()
         elif self.qs:
             self.onKeyPressedQs(ks, key)
         elif ks in Qs.OPEN:
+            reader.renderTo()  # search in the whole message
             self.qs = newQuickSearch(reader.tokens, self.onSearchItem)
         elif ks in Reader.QUIT:
             if msgs.stack:
@@ -1828,6 +2246,7 @@ class EchoReaderScreen(Window):
                 showMessageBox("Не удалось определить msgid.\n" + str(ex))
 
         elif ks in Reader.LINKS:
+            reader.renderTo()
             self.showOpenLinkDialog(reader.tokens)
 
         elif ks in Reader.TO_OUT and self.drafts:
@@ -1880,6 +2299,7 @@ class EchoReaderScreen(Window):
         self.reader.prerender(self.reader.scrollV.pos)
         self.scr.clear()
         if self.qs:
+            self.reader.renderTo()
             self.qs.items = self.reader.tokens
             self.qs.y = self.h - 1
             self.qs.onResize(self.w - len(version) - 13)
@@ -1965,6 +2385,11 @@ class Counts:
         self.total[config.ECHO_DRAFTS.name] = mailer.getOutLength(node, True)
         self.total[config.ECHO_OUT.name] = mailer.getOutLength(node, False)
 
+    def updateCounts(self, echoareas):  # type: (Set[str]) -> None
+        for echo in echoareas:
+            self.total[echo] = API.getEchoLength(echo)
+        self.total[config.ECHO_CARBON.name] = len(API.getCarbonarea())
+
     def rescanCounts(self, echoareas):
         self.counts = []
         for echo in echoareas:
@@ -2041,9 +2466,11 @@ class EchoSelectorScreen(Window):
             self.scroll.ensureVisible(self.echos.idx)
             self.draw(self.scr)
             #
-            ks, key, _ = getKeystroke()
+            ks, key, _ = getKeystroke(SYNC_REDRAW if sync else -1)
             #
-            if key == curses.KEY_RESIZE:
+            if not ks and not key:
+                continue  # redraw the counts updated by sync
+            elif key == curses.KEY_RESIZE:
                 self.onResize()
             elif self.qs:
                 if ks in Qs.CLOSE or ks in Qs.APPLY:
@@ -2119,8 +2546,8 @@ class EchoSelectorScreen(Window):
                 win.addstr(y, max(self.w - m - 1, self.w - 1 - len(echo.desc)),
                            echo.desc[0:self.w - 38])
             #
-            if qs and echoN in qs.result:
-                idx = qs.result.index(echoN)
+            idx = qs.byPos.get(echoN) if qs else None
+            if idx is not None:
                 for match in qs.matches[idx]:
                     win.addstr(y, 2 + match.start(),
                                echo.name[match.start():match.end()],
@@ -2150,7 +2577,9 @@ class EchoSelectorScreen(Window):
         elif ks in Selector.END:
             self.echos.idx = self.scroll.content - 1
         elif ks in Selector.GET or ks in Selector.FGET:
-            self.fetchMail(forceFullIdx=(ks in Selector.FGET))
+            self.fetchMail([CFG.node()], forceFullIdx=(ks in Selector.FGET))
+        elif ks in Selector.GETALL:
+            self.fetchMail(CFG.nodes, forceFullIdx=False)
         elif ks in Selector.ARCHIVE and len(CFG.node().archive) > 0:
             self.toggleArchive()
         elif ks in Selector.ENTER:
@@ -2174,21 +2603,24 @@ class EchoSelectorScreen(Window):
             if win.resized:
                 self.onResize()
             if findResult:
-                findResult = sorted(findResult, key=lambda m: m.time)
                 self.showReader(EchoReaderScreen(
                     self.scr, config.ECHO_FIND, 0, True, self.counts,
-                    mode=ReaderMode.FIND, msgids=findResult))
-
-    def fetchMail(self, forceFullIdx):
-        terminateCurses()
-        os.system('cls' if os.name == 'nt' else 'clear')
-        mailer.fetchMail(CFG.node(), forceFullIdx)
-        initializeCurses()
-        drawMessageBox("Подождите", False)
-        self.counts.getCounts(CFG.node(), True)
+                    mode=ReaderMode.FIND, msgids=findResult, stream=win.stream))
+
+    def fetchMail(self, nodes, forceFullIdx):
+        # type: (List[config.Node], bool) -> None
+        global sync, onSyncSaved
+        if sync and sync.is_alive():
+            return  # one sync at a time
+        sync = mailer.SyncThread(nodes, forceFullIdx)
+        onSyncSaved = self.onSyncSaved
+        sync.start()
+
+    def onSyncSaved(self, echoareas, finished):  # type: (Set[str], bool) -> None
+        self.counts.updateCounts(echoareas)
         self.counts.rescanCounts(self.echos.data)
-        self.scr.clear()
-        self.echos.idx = self.counts.findNew(0)
+        if finished:
+            self.echos.idx = self.counts.findNew(0)
 
     def readEcho(self, echo):
         drawMessageBox("Подождите", False)
@@ -55,6 +55,23 @@ def offsetsEchoCount(old, new):
     return offsets
 
 
+def offsetsEchoHash(oldCounts, newCounts, oldHashes, newHashes):
+    # type: (dict[str, int], dict[str, int], dict[str, str], dict[str, str]) -> dict[str, int]
+    offsets = {}
+    for echo, count in newCounts.items():
+        old = oldCounts.get(echo)
+        if echo in oldHashes and echo in newHashes:
+            if oldHashes[echo] == newHashes[echo]:
+                continue  # unchanged
+            # changed without growing (removed, replaced msgs): full index
+            offsets[echo] = old if old is not None and old < count else 0
+        elif old is None:
+            offsets[echo] = 0
+        elif old < count:
+            offsets[echo] = old
+    return offsets
+
+
 def quickSearch(pattern, content) -> List[re.Match]:
     result = []
     pos = 0
@@ -37,6 +37,7 @@ s.HOME.ks =    []  # noqa: E222  в начало
 s.END.ks =     []  # noqa: E222  в конец
 s.GET.ks =     []  # noqa: E222  получить сообщения (свежие по счётчику)
 s.FGET.ks =    []  # noqa: E222  получить сообщения (полный индекс)
+s.GETALL.ks =  []  # noqa: E222  получить сообщения со всех нод
 s.ARCHIVE.ks = []  # noqa: E222  переключение в архив и обратно
 s.ENTER.ks =   []  # noqa: E222  открыть эху
 s.OUT.ks =     []  # noqa: E222  исходящие сообщения
@@ -36,6 +36,7 @@ s.HOME.ks =    ["Home", "^"]  # noqa: E222  в начало
 s.END.ks =     ["End", "$"]  # noqa: E222  в конец
 s.GET.ks =     ["g", "S-g"]  # noqa: E222  получить сообщения (свежие по счётчику)
 s.FGET.ks =    ["C-g"]  # noqa: E222  получить сообщения (полный индекс)
+s.GETALL.ks =  ["M-g"]  # noqa: E222  получить сообщения со всех нод
 s.ARCHIVE.ks = ["Tab"]  # noqa: E222  переключение в архив и обратно
 s.ENTER.ks =   ["RET", "Right", "SPC"]  # noqa: E222  открыть эху
 s.OUT.ks =     ["o", "S-o"]  # noqa: E222  исходящие сообщения
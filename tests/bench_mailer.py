@@ -0,0 +1,44 @@
+# Sync planning (mailer.diffIndex) time against the local index size.
+#
+#   python3 -m tests.bench_mailer
+import time
+
+from core import mailer
+
+
+def msgid(n):
+    return "%020d" % n
+
+
+def diffIndexLists(remoteMsgList, getEchoMsgids):
+    # pre-set implementation, for comparison
+    fetchMsgList = []
+    localIndex = None
+    for line in remoteMsgList:
+        if mailer.parser.echoTemplate.match(line):
+            localIndex = getEchoMsgids(line)
+        elif len(line) == 20 and line not in localIndex and line not in mailer.blacklist:
+            fetchMsgList.append(line)
+    return fetchMsgList
+
+
+def bench(diff, size):
+    local = [msgid(n) for n in range(size)]
+    remote = ["bench.echo"] + [msgid(n) for n in range(size + size // 100)]
+    start = time.perf_counter()
+    fetch = diff(remote, lambda echo: local)
+    elapsed = time.perf_counter() - start
+    assert len(fetch) == size // 100
+    return elapsed
+
+
+def main():
+    mailer.blacklist = set(msgid(-n) for n in range(1, 1000))
+    print("%10s %12s %12s" % ("msgids", "sets, s", "lists, s"))
+    for size in (1000, 10000, 20000, 100000, 500000):
+        lists = "%12.3f" % bench(diffIndexLists, size) if size <= 20000 else "%12s" % "-"
+        print("%10d %12.3f %s" % (size, bench(mailer.diffIndex, size), lists))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+import shutil
+from pathlib import Path
+
+import pytest
+
+
+@pytest.fixture
+def api(storage, tmp_path):
+    # a copy of the checked-in storage: the tests don't leave the sidecars
+    # (locator, search.db, .idx, nodes/) or the saved messages in the repo
+    if storage == "aio":
+        import api.aio as api
+        db = "test.aio"
+    elif storage == "ait":
+        import api.ait as api
+        db = "test.ait"
+    elif storage == "sqlite":
+        import api.sqlite as api
+        db = "test.db"
+    elif storage == "txt":
+        import api.txt as api
+        db = "test.txt"
+    else:
+        raise ValueError("Unknown API")
+    src = Path(__file__).parent / db
+    if src.is_dir():
+        shutil.copytree(src, tmp_path / db)
+    else:
+        shutil.copy(src, tmp_path / db)
+    api.init(str(tmp_path / db))
+    clean(api)
+    yield api
+
+
+def clean(api):
+    api.removeEchoarea("test.local")
+    api.removeEchoarea("test2.local")
+    api.removeEchoarea("test3.local")
+    api.removeEchoarea("carbonarea")
+    api.removeEchoarea("favorites")
+    api.removeEchoarea("idec.talks")
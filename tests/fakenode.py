@@ -0,0 +1,178 @@
+# Local stand-in ii node for the client and mailer tests.
+import base64
+import contextlib
+import gzip
+import hashlib
+import threading
+import time
+import urllib.parse
+from typing import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeNode:
+    def __init__(self):
+        self.echoes = {}  # echo -> [msgid]
+        self.msgs = {}  # msgid -> raw message text
+        self.features = ["u/e", "x/c", "x/h", "x/filter"]
+        self.auth = "secret"
+        self.posted = []  # raw messages received by u/point
+        self.connections = 0
+        self.requests = []  # request paths
+        self.gzip = False
+        self.dropIdle = False  # close the connection behind the client's back
+        self.dropReply = False  # close the connection instead of the response
+        self.delay = 0  # seconds before every response
+        self.onRequest = None  # called with the path of every request in progress
+        self.bundlesLeft = None  # u/m requests to serve before the node fails
+        self.active = 0  # requests in progress
+        self.maxActive = 0
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                with node.lock:
+                    node.connections += 1
+                super().setup()
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with node.request(self.path):
+                    status, text = node.handle(self.path)
+                self.reply(status, text)
+
+            def do_POST(self):
+                with node.request(self.path):
+                    length = int(self.headers.get("Content-Length", 0))
+                    form = urllib.parse.parse_qs(self.rfile.read(length).decode("utf-8"),
+                                                  keep_blank_values=True)
+                    status, text = node.handlePost(self.path, form)
+                self.reply(status, text)
+
+            def reply(self, status, text):
+                if node.dropReply:
+                    self.close_connection = True
+                    return
+                data = text.encode("utf-8")
+                self.send_response(status)
+                if node.gzip and "gzip" in self.headers.get("Accept-Encoding", ""):
+                    data = gzip.compress(data)
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Type", "text/plain; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+                if node.dropIdle:
+                    self.close_connection = True
+
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:%d/" % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       args=(0.05,), daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @contextlib.contextmanager
+    def request(self, path):
+        with self.lock:
+            self.requests.append(path)
+            self.active += 1
+            self.maxActive = max(self.maxActive, self.active)
+        try:
+            time.sleep(self.delay)
+            if self.onRequest:
+                self.onRequest(path)
+            yield
+        finally:
+            with self.lock:
+                self.active -= 1
+
+    def add(self, echo, msgid, text):
+        self.echoes.setdefault(echo, []).append(msgid)
+        self.msgs[msgid] = text
+
+    def echoHash(self, echo):
+        return hashlib.sha256("".join(self.echoes.get(echo, [])).encode("ascii")) \
+            .hexdigest()[:20]
+
+    def handle(self, path):
+        parts = [p for p in path.lstrip("/").split("/") if p]
+        if parts[:2] == ["u", "e"]:
+            echoes, offset = parts[2:], None
+            if echoes and ":" in echoes[-1]:
+                offset = tuple(map(int, echoes.pop().split(":")))
+            lines = []
+            for echo in echoes:
+                msgids = self.echoes.get(echo, [])
+                if offset:
+                    start = offset[0] if offset[0] >= 0 else max(0, len(msgids) + offset[0])
+                    msgids = msgids[start:start + offset[1]]
+                lines += [echo] + msgids
+            return 200, "".join(line + "\n" for line in lines)
+        if parts[:2] == ["u", "m"]:
+            with self.lock:
+                if self.bundlesLeft is not None:
+                    if self.bundlesLeft <= 0:
+                        return 500, "node is down"
+                    self.bundlesLeft -= 1
+            return 200, "".join(
+                "%s:%s\n" % (m, base64.b64encode(self.msgs[m].encode("utf-8"))
+                             .decode("ascii"))
+                for m in parts[2:] if m in self.msgs)
+        if parts[:2] == ["x", "c"]:
+            return 200, "".join("%s:%d\n" % (e, len(self.echoes.get(e, [])))
+                                for e in parts[2:])
+        if parts[:2] == ["x", "h"]:
+            return 200, "".join("%s:%s\n" % (e, self.echoHash(e))
+                                for e in parts[2:])
+        if parts == ["x", "features"]:
+            return 200, "".join(f + "\n" for f in self.features)
+        return 404, "not found"
+
+    def handlePost(self, path, form):
+        if path.rstrip("/") == "/u/push" and "u/push" in self.features:
+            if form.get("nauth", [""])[0] != self.auth:
+                return 200, "auth error!"
+            # node-to-node: a bundle of msgid:base64 lines of the echoarea
+            for line in filter(None, form["upush"][0].split("\n")):
+                msgid, msg = line.split(":", 1)
+                self.add(form["echoarea"][0], msgid,
+                         base64.b64decode(msg).decode("utf-8"))
+            return 200, "message saved: ok"
+        if path.rstrip("/") != "/u/point":
+            return 404, "not found"
+        if form.get("pauth", [""])[0] != self.auth:
+            return 200, "auth error!"
+        return 200, self.post(form["tmsg"][0])
+
+    def post(self, tmsg):
+        msg = base64.b64decode(tmsg).decode("utf-8")
+        if len(msg) > 65536:
+            return "msg big!"
+        with self.lock:
+            self.posted.append(msg)
+            return "msg ok:%020d" % len(self.posted)
+
+
+def waitActive(node, count):  # type: (FakeNode, int) -> Callable[[str], None]
+    # onRequest: requests wait until count of them are in progress at once
+    full = threading.Event()
+
+    def onRequest(path):
+        if node.active >= count:
+            full.set()
+        full.wait(5)
+    return onRequest
@@ -42,38 +42,6 @@ def test_initTxt():
     shutil.rmtree("test2.txt")
 
 
-@pytest.fixture
-def api(storage):
-    if storage == "aio":
-        import api.aio as api
-        api.init("test.aio")
-    elif storage == "ait":
-        import api.ait as api
-        api.init("test.ait")
-    elif storage == "sqlite":
-        import api.sqlite as api
-        api.init("test.db")
-    elif storage == "txt":
-        import api.txt as api
-        api.init("test.txt")
-    else:
-        raise ValueError("Unknown API")
-    clean(api)
-    try:
-        yield api
-    finally:
-        clean(api)
-
-
-def clean(api):
-    api.removeEchoarea("test.local")
-    api.removeEchoarea("test2.local")
-    api.removeEchoarea("test3.local")
-    api.removeEchoarea("carbonarea")
-    api.removeEchoarea("favorites")
-    api.removeEchoarea("idec.talks")
-
-
 # noinspection PyTestParametrized
 @pytest.mark.parametrize("storage", ["aio", "ait", "sqlite", "txt"])
 def test_getEchoLength(api):
@@ -126,6 +94,20 @@ def test_addToCarbonarea(api):
     assert data == [MsgMetadata.fromList("2" * 20, msg2)]
 
 
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["aio", "ait", "sqlite", "txt"])
+def test_saveMessageCarbonBundle(api):
+    msg = ["ii/ok", "test.local", "0", "admin", "node,1", "user,admin", "Subj", "", "Msg"]
+    api.saveMessage([("1" * 20, msg)], "node", ["user"])
+    assert api.getCarbonarea() == ["1" * 20]
+
+    bundle = [(str(i) * 20, msg) for i in range(2, 6)]
+    api.saveMessage(bundle, "node", ["user", "admin"])
+    assert api.getEchoLength("test.local") == 5
+    assert api.getCarbonarea() == [str(i) * 20 for i in range(1, 6)]
+    assert api.readMsg("5" * 20, "carbonarea")[0] == msg
+
+
 # noinspection PyTestParametrized
 @pytest.mark.parametrize("storage", ["aio", "ait", "sqlite", "txt"])
 def test_saveFavorites(api):
@@ -206,6 +188,162 @@ def test_findMsg(api):
     assert size == 81
 
 
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["aio", "ait"])
+def test_matOffsetIndex(api):
+    from api import mat
+    msg1 = ["ii/ok", "test.local", "0", "admin", "node,1", "All", "Сабж", "", "Мсг1", "Row2"]
+    msg2 = ["ii/ok", "test.local", "0", "admin", "node,1", "All", "Subj", "", "Msg2", "Row2"]
+    msg3 = ["ii/ok", "test.local", "0", "admin", "node,1", "All", "Subj", "", "Msg3", "Row2"]
+    api.saveMessage([("1" * 20, msg1), ("2" * 20, msg2)], "node", None)
+    path = api.storage + "test.local." + ("mat" if api.storage.endswith(".ait/") else "aio")
+    assert Path(mat.idxPath(path)).is_file()
+    assert api.readMsg("2" * 20, "test.local")[0] == msg2
+    assert api.readMsg("3" * 20, "test.local")[0] is None
+    # appended by someone else
+    with open(path, "a") as f:
+        f.write("3" * 20 + ":" + chr(15).join(msg3) + "\n")
+    assert api.readMsg("3" * 20, "test.local")[0] == msg3
+    # old format sidecar
+    mat.invalidate(path)
+    with open(mat.idxPath(path), "w") as f:
+        f.write("1" * 20 + ":0:1\n")
+    assert api.readMsg("2" * 20, "test.local")[0] == msg2
+    assert [h[0] for h in mat.headers(path)] == ["1" * 20, "2" * 20, "3" * 20]
+    # lost sidecar
+    mat.invalidate(path)
+    assert api.readMsg("1" * 20, "test.local")[0] == msg1
+    assert api.readMsg("3" * 20, "test.local")[0] == msg3
+    api.removeEchoarea("test.local")
+    assert not Path(mat.idxPath(path)).exists()
+
+
+def test_matHeaders(tmp_path):
+    from api import mat
+    path = str(tmp_path / "test.local.mat")
+    assert mat.headers(path) == []
+    with open(path, "w") as f:
+        f.write("")
+    assert mat.headers(path) == []
+    with open(path, "w") as f:
+        f.write("\n" + "1" * 20 + ":ii/ok\x0ftest.local\x0f0\x0fu\x0fn,1\x0fAll\x0fS:j\x0f\x0fb:1\n"
+                + "\n" + "2" * 20 + ":ii/ok\x0ftest.local\x0f1\x0fu\x0fn,1\x0fAll\x0fСабж")
+    assert mat.headers(path) == [
+        ("1" * 20, ["ii/ok", "test.local", "0", "u", "n,1", "All", "S:j"]),
+        ("2" * 20, ["ii/ok", "test.local", "1", "u", "n,1", "All", "Сабж"])]
+
+
+def test_matHeadersCached(tmp_path, monkeypatch):
+    from api import mat
+    path = str(tmp_path / "test.local.mat")
+    msg = ["ii/ok", "test.local", "0", "u", "n,1", "All", "Сабж", "", "Мсг"]
+    mat.append(path, [("1" * 20, msg)])
+    mat._cache.clear()
+    assert [h[0] for h in mat.headers(path)] == ["1" * 20]
+    # appended by us and by another tool
+    mat.append(path, [("2" * 20, msg)])
+    with open(path, "a") as f:
+        f.write("3" * 20 + ":" + chr(15).join(msg) + "\n")
+    monkeypatch.setattr(mat, "_readIdx", None)  # warm: the sidecar isn't read
+    assert mat.headers(path) == [(str(i) * 20, msg[:7]) for i in range(1, 4)]
+
+
+def test_matMetadata(tmp_path):
+    from api import mat
+    path = str(tmp_path / "test.local.mat")
+    msg = ["ii/ok", "test.local", "0", "u", "n,1", "All", "Сабж", "", "Мсг"]
+    mat.append(path, [("1" * 20, msg)])
+    first = mat.metadata(path, MsgMetadata.fromList)
+    mat.append(path, [("2" * 20, msg)])
+    second = mat.metadata(path, MsgMetadata.fromList)
+    assert second[0] is first[0]  # not made again
+    assert [m.msgid for m in second] == ["1" * 20, "2" * 20]
+    mat.invalidate(path)
+    assert mat.metadata(path, MsgMetadata.fromList)[0] is not first[0]
+
+
+def test_matAppendUncached(tmp_path):
+    from api import mat
+    path = str(tmp_path / "test.local.mat")
+    msg = ["ii/ok", "test.local", "0", "u", "n,1", "All", "Сабж", "", "Мсг"]
+    mat.append(path, [("1" * 20, msg)])
+    mat._cache.clear()
+    mat.append(path, [("2" * 20, msg)])
+    assert path not in mat._cache  # sidecar is not read
+    with open(path, "a") as f:
+        f.write("3" * 20 + ":" + chr(15).join(msg) + "\n")
+    mat.append(path, [("4" * 20, msg)])
+    mat._cache.clear()
+    assert [mat.readMsg(path, str(i) * 20) for i in range(1, 5)] == [msg] * 4
+
+
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["aio", "ait", "sqlite", "txt"])
+def test_findMsgLocator(api):
+    msg1 = ["ii/ok", "test.local", "0", "admin", "node,1", "All", "Subj", "", "Msg1", "Row2"]
+    msg2 = ["ii/ok", "test2.local", "0", "admin", "node,1", "All", "Subj", "", "Msg2", "Row2"]
+    api.saveMessage([("1" * 20, msg1), ("2" * 20, msg2)], "node", None)
+    assert api.findMsg("1" * 20)[0] == msg1
+    assert api.findMsg("2" * 20)[0] == msg2
+    #
+    api.removeEchoarea("test2.local")
+    assert api.findMsg("2" * 20)[1] == 0
+    #
+    api.rebuildIndex()
+    assert api.findMsg("1" * 20)[0] == msg1
+    assert api.findMsg("25Ll1pZMnIbdWB8Ring2")[0][1] == "ring2.global"
+
+
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["aio", "ait"])
+def test_findMsgAppendedByOtherTool(api, monkeypatch):
+    from api import locator, mat
+    msg1 = ["ii/ok", "test.local", "0", "admin", "node,1", "All", "Subj", "", "Msg1"]
+    msg2 = ["ii/ok", "test.local", "1", "admin", "node,1", "All", "Subj", "", "Msg2"]
+    api.saveMessage([("1" * 20, msg1)], "node", None)
+    assert api.findMsg("1" * 20)[0] == msg1
+    ext = ".aio" if api.storage.endswith("aio/") else ".mat"
+    with open(api.storage + "test.local" + ext, "a") as f:
+        f.write("2" * 20 + ":" + chr(15).join(msg2) + "\n")
+    assert locator.get(api.storage, "2" * 20) is None
+    assert api.findMsg("2" * 20)[0] == msg2
+    assert locator.get(api.storage, "2" * 20)[0] == "test.local"
+    # indexed echoes aren't read on a miss
+    mat._cache.clear()
+    monkeypatch.setattr(mat, "_readIdx", None)
+    assert api.findMsg("3" * 20)[1] == 0
+
+
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["aio", "ait", "sqlite", "txt"])
+def test_saveMessageImport(api):
+    msg = ["ii/ok", "test.local", "0", "admin", "node,1", "user", "Subj", "", "Msg"]
+    api.beginImport()
+    api.saveMessage([(str(i) * 20, msg) for i in range(1, 4)], "node", ["user"])
+    api.endImport()
+    assert api.getEchoMsgids("test.local") == [str(i) * 20 for i in range(1, 4)]
+    assert api.getCarbonarea() == [str(i) * 20 for i in range(1, 4)]
+    if api.__name__ == "api.sqlite":
+        indexes = [r[0] for r in api.c.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'msg';")]
+        assert set(api.MSG_INDEXES).issubset(indexes)
+
+
+def test_sqliteInterruptedImport(tmp_path):
+    from api import sqlite
+    msg = ["ii/ok", "test.local", "0", "admin", "node,1", "All", "Subj", "", "zxcqwe"]
+    sqlite.init(str(tmp_path / "idec.db"))
+    sqlite.beginImport()
+    sqlite.saveMessage([("1" * 20, msg)], "node", None)
+    sqlite.con.close()  # killed before endImport
+
+    sqlite.init(str(tmp_path / "idec.db"))
+    assert sqlite.fts
+    assert sqlite.c.execute("SELECT rowid FROM msg_fts WHERE msg_fts MATCH ?;",
+                            ('"zxc"',)).fetchall() == [(1,)]
+    sqlite.con.close()
+
+
 # noinspection PyTestParametrized
 @pytest.mark.parametrize("storage", ["aio", "ait", "sqlite", "txt"])
 def test_nodeFeatures(api):
@@ -236,6 +374,21 @@ def test_nodeEchoCounts(api):
     assert ec == {"echo.2": 2, "echo.3": 3}
 
 
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["aio", "ait", "sqlite", "txt"])
+def test_nodeEchoHashes(api):
+    eh = api.getNodeEchoHashes("unknown")
+    assert eh is None
+    #
+    api.saveNodeEchoHashes("node", {"echo.1": "hash1", "echo.2": "hash2"})
+    eh = api.getNodeEchoHashes("node")
+    assert eh == {"echo.1": "hash1", "echo.2": "hash2"}
+    #
+    api.saveNodeEchoHashes("node", {"echo.2": "hash3"})
+    eh = api.getNodeEchoHashes("node")
+    assert eh == {"echo.2": "hash3"}
+
+
 # noinspection PyTestParametrized
 @pytest.mark.parametrize("storage", ["aio", "ait", "sqlite", "txt"])
 def test_findSubjMsgids(api):
@@ -412,6 +565,115 @@ def test_findQueryEmpty(api):
     assert len(data) == 1
 
 
+@pytest.mark.parametrize("storage", ["sqlite"])
+def test_findQueryFts(api):
+    assert api.fts
+    msgs = [("1" * 20, ["ii/ok", "test.local", "0", "u", "n,1", "t", "Тема", "", "zxcQWE \"q\""]),
+            ("2" * 20, ["ii/ok", "test.local", "1", "u", "n,1", "t", "S", "", "", " +++ zxcqwe"]),
+            ("3" * 20, ["ii/ok", "test.local", "1", "Юзер", "n,1", "t", "S", "", "", "zx qwe+"]),
+            ("4" * 20, ["ii/ok", "test2.local", "1", "u", "n,1", "t", "S", "", "", "xc qw"])]
+    api.saveMessage(msgs, "node", None)
+    api.c.execute("UPDATE msg SET subject = 'zxc' WHERE msgid = ?;", ("4" * 20,))
+    api.removeEchoarea("test2.local")
+
+    queries = [FindQuery(query=q, queryNot=qn, case=case, word=word, orig=orig)
+               for q, qn in (("zxc", ""), ("ZXC", ""), ("qwe", "+++"), ("qwe", "zxc"),
+                             ("q\"", ""), ("юзер", ""), ("тем", ""), ("qw", ""), ("xc", ""))
+               for case in (False, True)
+               for word in (False, True)
+               for orig in (False, True)]
+    found = [api.findQueryMsgids(fq) for fq in queries]
+    api.fts = False
+    try:
+        assert found == [api.findQueryMsgids(fq) for fq in queries]
+    finally:
+        api.fts = True
+    assert found[0] == [MsgMetadata.fromList(m[0], m[1]) for m in msgs[0:1]]
+
+
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["aio", "ait", "txt"])
+def test_findQuerySearchIndex(api, monkeypatch):
+    from api import search
+    msgs = [("1" * 20, ["ii/ok", "test.local", "0", "u", "n,1", "t", "Тема", "", "zxcQWE \"q\""]),
+            ("2" * 20, ["ii/ok", "test.local", "1", "u", "n,1", "t", "S", "", "", " +++ zxcqwe"]),
+            ("3" * 20, ["ii/ok", "test2.local", "1", "Юзер", "n,1", "t", "S", "", "", "zx qwe+"]),
+            ("4" * 20, ["ii/ok", "test3.local", "1", "u", "n,1", "t", "zxc", "", "", "xc qw"])]
+    api.saveMessage(msgs, "node", None)
+    api.removeEchoarea("test3.local")
+
+    queries = [FindQuery(query=q, queryNot=qn, case=case, word=word, orig=orig)
+               for q, qn in (("zxc", ""), ("ZXC", ""), ("qwe", "+++"), ("qwe", "zxc"),
+                             ("q\"", ""), ("юзер", ""), ("тем", ""), ("qw", ""),
+                             ("1" * 20, ""), ("25Ll1pZMnIbdWB8Ring2", ""))
+               for case in (False, True)
+               for word in (False, True)
+               for orig in (False, True)]
+    found = [api.findQueryMsgids(fq) for fq in queries]
+    assert search.isBuilt(api.storage)
+    monkeypatch.setattr(search, "candidates", lambda storage, fq: None)
+    assert found == [api.findQueryMsgids(fq) for fq in queries]
+    assert found[0] == [MsgMetadata.fromList(m[0], m[1]) for m in msgs[0:1]]
+    assert found[8 * 8] == [MsgMetadata.fromList(m[0], m[1]) for m in msgs[0:1]]
+    assert found[9 * 8][0].echo == "ring2.global"
+    monkeypatch.undo()
+    msg5 = ("5" * 20, ["ii/ok", "test.local", "2", "u", "n,1", "t", "S", "", "", "qzxc"])
+    api.saveMessage([msg5], "node", None)
+    read = []
+    tailMsgs = api._tailMsgs
+    monkeypatch.setattr(api, "_tailMsgs", lambda *args: read.append(args) or tailMsgs(*args))
+    assert api.findQueryMsgids(queries[0])[-1] == MsgMetadata.fromList(*msg5)
+    assert len(read) == 1 and read[0][1] > 0  # appended part of the echo only
+
+
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["aio", "ait", "txt"])
+def test_searchIndexLazy(api, monkeypatch):
+    from api import search
+    search.clear(api.storage)
+    monkeypatch.setattr(search, "update", lambda *args: pytest.fail("indexed"))
+    msg = ("1" * 20, ["ii/ok", "test.local", "0", "u", "n,1", "t", "S", "", "zxc"])
+    api.saveMessage([msg], "node", None)
+    assert api.findMsg("1" * 20)[0] == msg[1]
+    assert not search.isBuilt(api.storage)
+
+
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["aio", "ait", "txt"])
+def test_findQueryWorkers(api):
+    msgs = [(str(i) * 20, ["ii/ok", ("test.local", "test2.local", "test3.local")[i % 3],
+                           str(i), "u", "n,1", "t", "S", "", "msg %d" % i])
+            for i in range(1, 10)]
+    api.saveMessage(msgs, "node", None)
+    queries = [FindQuery(query=q, regex=regex, limit=limit)
+               for q, regex in (("msg [2-7]", True), ("msg", False), ("", False))
+               for limit in (3, FindQuery.DEFAULT_LIMIT)]
+    found = [api.findQueryMsgids(fq) for fq in queries]
+    for fq in queries:
+        fq.workers = 2
+    progress = []
+    assert found == [api.findQueryMsgids(fq, progress.append) for fq in queries]
+    assert found[0] == [MsgMetadata.fromList(*msgs[i]) for i in (2, 5, 3)]
+    assert progress
+    assert api.findQueryMsgids(queries[1], lambda p: api.FIND_CANCEL) == []
+
+
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["aio", "ait", "sqlite", "txt"])
+def test_iterQueryMsgids(api):
+    msgs = [(str(i) * 20, ["ii/ok", "test.local", str(i), "u", "n,1", "t", "S", "", "msg %d" % i])
+            for i in range(1, 10)]
+    api.saveMessage(msgs, "node", None)
+    fq = FindQuery(query="msg [1-8]", regex=True)
+    progress = []
+    found = api.iterQueryMsgids(fq, progress.append)
+    assert next(found) == MsgMetadata.fromList(*msgs[0])
+    assert progress  # before the whole scan
+    found.close()
+    assert api.findQueryMsgids(fq) == [MsgMetadata.fromList(*m) for m in msgs[0:8]]
+    assert api.findQueryMsgids(fq, lambda p: api.FIND_CANCEL) == []
+
+
 def test_findMatcherRegex():
     # any case, anywhere
     matcher = buildFindMatcher(
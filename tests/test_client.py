@@ -0,0 +1,159 @@
+import asyncio
+import base64
+import select
+
+import pytest
+
+from core import aclient, client
+from tests.fakenode import FakeNode, waitActive
+
+MSG = "ii/ok\ntest.local\n1700000000\nfrom\nnode,1\nAll\nsubj\n\nbody"
+
+
+@pytest.fixture
+def node():
+    client.close()
+    with FakeNode() as n:
+        for i in range(30):
+            n.add("test.local" if i % 2 else "test2.local", "%020d" % i, MSG)
+        yield n
+    client.close()
+
+
+def test_getMsgList(node):
+    msgs = client.getMsgList(node.url, ["test.local", "test2.local"])
+    assert msgs[0] == "test.local"
+    assert msgs[1:16] == ["%020d" % i for i in range(1, 30, 2)]
+    assert msgs[16] == "test2.local"
+    assert client.getMsgList(node.url, ["test.local"], -2, 2) \
+        == ["test.local", "%020d" % 27, "%020d" % 29]
+
+
+def test_getBundle(node):
+    bundle = client.getBundle(node.url, "%020d/%020d" % (1, 2))
+    assert [b.split(":")[0] for b in bundle] == ["%020d" % 1, "%020d" % 2]
+    assert base64.b64decode(bundle[0].split(":")[1]).decode("utf-8") == MSG
+
+
+def test_getEchoCountHash(node):
+    assert client.getEchoCount(node.url, ["test.local", "none.local"]) \
+        == {"test.local": 15, "none.local": 0}
+    assert client.getEchoHash(node.url, ["test.local"]) \
+        == {"test.local": node.echoHash("test.local")}
+    assert client.getFeatures(node.url) == node.features
+
+
+def test_sendMsg(node):
+    msg = base64.b64encode(MSG.encode("utf-8")).decode("ascii")
+    assert client.sendMsg(node.url, "secret", msg).startswith("msg ok")
+    assert client.sendMsg(node.url, "wrong", msg) == "auth error!"
+    assert node.posted == [MSG]
+
+
+def test_keepAlive(node):
+    for i in range(10):
+        client.getBundle(node.url, "%020d" % i)
+        client.getEchoCount(node.url, ["test.local"])
+    client.sendMsg(node.url, "secret", "")
+    assert len(node.requests) == 21
+    assert node.connections == 1
+
+
+def test_keepAliveGzip(node):
+    node.gzip = True
+    assert client.getMsgList(node.url, ["test.local"])[0] == "test.local"
+    assert client.getBundle(node.url, "%020d" % 1)[0].startswith("%020d:" % 1)
+    assert node.connections == 1
+
+
+def test_keepAliveDropped(node):
+    node.dropIdle = True  # node closes every connection after the response
+    for i in range(3):
+        assert client.getEchoCount(node.url, ["test.local"]) == {"test.local": 15}
+    assert node.connections == 3
+    msg = base64.b64encode(MSG.encode("utf-8")).decode("ascii")
+    for _ in range(2):
+        # idle connection closed by the node: not reused for the POST
+        idle = client._pool[client.nodeKey(node.url)][0]
+        assert select.select([idle.sock], [], [], 5)[0]
+        assert client.sendMsg(node.url, "secret", msg).startswith("msg ok")
+    assert node.posted == [MSG, MSG]
+
+
+def test_postNotRetried(node):
+    msg = base64.b64encode(MSG.encode("utf-8")).decode("ascii")
+    assert client.sendMsg(node.url, "secret", msg).startswith("msg ok")
+    node.dropReply = True  # posted, but the response is lost
+    with pytest.raises(client.http.client.RemoteDisconnected):
+        client.sendMsg(node.url, "secret", msg)
+    assert node.posted == [MSG, MSG]
+    node.dropReply = False
+    assert client.getEchoCount(node.url, ["test.local"]) == {"test.local": 15}
+
+
+def test_httpError(node):
+    with pytest.raises(client.urllib.error.HTTPError):
+        client.getBundle(node.url + "missing/", "1")
+    assert client.getFeatures(node.url + "missing/")[0].startswith("error:")
+
+
+@pytest.mark.parametrize("gzip", [False, True])
+def test_iterLines(node, monkeypatch, gzip):
+    monkeypatch.setattr(client, "CHUNK_SIZE", 7)  # split utf-8 chars and lines
+    node.gzip = gzip
+    node.features = ["u/e", "эхо/конференция", "x/c" * 50, "последняя"]
+    assert list(client._iterLines(node.url + "x/features")) == node.features
+    msgs = client.iterMsgList(node.url, ["test.local"])
+    assert next(msgs) == "test.local"
+    assert list(msgs) == ["%020d" % i for i in range(1, 30, 2)]
+    assert client.getEchoCount(node.url, ["test.local"]) == {"test.local": 15}
+    assert node.connections == 1
+
+
+def test_iterLinesAbandoned(node):
+    msgs = client.iterMsgList(node.url, ["test.local"])
+    assert next(msgs) == "test.local"
+    msgs.close()  # unread body: connection can't be reused
+    assert client.getMsgList(node.url, ["test.local"])[0] == "test.local"
+    assert node.connections == 2
+
+
+class FakeClock:
+    def __init__(self):
+        self.sleeps = []
+
+    @staticmethod
+    def monotonic():
+        return 100.0
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+
+def test_rateLimit(node, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(client, "time", clock)
+    client.setRateLimit(node.url, 20)
+    try:
+        for _ in range(5):
+            client.getEchoCount(node.url, ["test.local"])
+        assert clock.sleeps == pytest.approx([0.05, 0.1, 0.15, 0.2])
+    finally:
+        client.setRateLimit(node.url, 0)
+    clock.sleeps.clear()
+    for _ in range(5):
+        client.getEchoCount(node.url, ["test.local"])
+    assert clock.sleeps == []
+
+
+def test_aclientNodeRequests(node):
+    node.onRequest = waitActive(node, aclient.NODE_REQUESTS)
+
+    async def counts():
+        return await asyncio.gather(*(aclient.getEchoCount(node.url, ["test.local"])
+                                      for _ in range(12)))
+
+    assert asyncio.run(counts()) == [{"test.local": 15}] * 12
+    assert node.maxActive == aclient.NODE_REQUESTS
+    assert asyncio.run(aclient.getMsgList(node.url, ["test.local"], -1, 1)) \
+        == ["test.local", "%020d" % 29]
@@ -0,0 +1,325 @@
+import base64
+import os
+import random
+import threading
+import time
+
+import pytest
+
+from core import aclient, client, config, mailer, FEAT_X_H, FEAT_U_PUSH
+from tests.fakenode import FakeNode, waitActive
+
+
+def test_diffIndex():
+    local = {"echo.1": ["1" * 20, "2" * 20], "echo.2": []}
+    remote = ["echo.1", "1" * 20, "2" * 20, "3" * 20,
+              "echo.2", "1" * 20, "4" * 20, "4" * 20, "short"]
+    fetch = mailer.diffIndex(remote, lambda echo: local[echo])
+    assert fetch == ["3" * 20, "1" * 20, "4" * 20]
+
+
+def test_diffIndexBlacklist(monkeypatch):
+    monkeypatch.setattr(mailer, "blacklist", {"3" * 20})
+    fetch = mailer.diffIndex(["echo.1", "1" * 20, "3" * 20], lambda echo: [])
+    assert fetch == ["1" * 20]
+
+
+def test_fetchBundles(monkeypatch):
+    requested = []
+
+    def getBundle(url, msgids):
+        msgids = msgids.split("/")
+        requested.append(len(msgids))
+        time.sleep(random.random() / 100)
+        return [m + ":" for m in msgids]
+
+    monkeypatch.setattr(mailer.client, "getBundle", getBundle)
+    fetchList = ["%020d" % i for i in range(3000)]
+    got = []
+    mailer.fetchBundles("http://node/", fetchList,
+                        lambda msgids, bundle: got.extend(m[:-1] for m in bundle))
+    assert got == fetchList
+    assert requested[0] == mailer.BUNDLE_MIN
+    assert max(requested) == mailer.BUNDLE_MAX  # fast node
+
+
+def test_fetchBundlesError(monkeypatch):
+    def getBundle(url, msgids):
+        if "%020d" % 500 in msgids:
+            raise OSError("node is down")
+        return []
+
+    monkeypatch.setattr(mailer.client, "getBundle", getBundle)
+    with pytest.raises(OSError):
+        mailer.fetchBundles("http://node/", ["%020d" % i for i in range(1000)],
+                            lambda msgids, bundle: None)
+
+
+def fakeMsg(echo, i):
+    return "ii/ok\n%s\n%d\nfrom\nnode,1\nAll\nsubj %d\n\nbody %d" % (
+        echo, 1700000000 + i, i, i)
+
+
+@pytest.fixture
+def node(api, monkeypatch, tmp_path):
+    monkeypatch.setattr(mailer, "storage", str(tmp_path) + "/")
+    client.close()
+    with FakeNode() as n:
+        n.features.append(FEAT_X_H)
+        for i in range(10):
+            echo = "test.local" if i % 2 else "test2.local"
+            n.add(echo, "%020d" % i, fakeMsg(echo, i))
+        cfgNode = config.Node(nodename="fake.node", url=n.url, echoareas=[
+            config.Echo("test.local", "", True),
+            config.Echo("test2.local", "", True)])
+        monkeypatch.setattr(mailer, "API", api)
+        monkeypatch.setattr(mailer.CFG, "nodes", [cfgNode])
+        monkeypatch.setattr(mailer.CFG, "_node", 0)
+        api.saveNodeFeatures(cfgNode.nodename, n.features)
+        api.saveNodeEchoCounts(cfgNode.nodename, {})
+        api.saveNodeEchoHashes(cfgNode.nodename, {})
+        yield n, cfgNode
+    client.close()
+
+
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["aio", "ait", "sqlite", "txt"])
+def test_getMailEchoHash(api, node):
+    node, cfgNode = node
+    mailer.getMail(cfgNode)
+    assert api.getEchoMsgids("test.local") == node.echoes["test.local"]
+    assert api.getNodeEchoHashes(cfgNode.nodename) == {
+        e: node.echoHash(e) for e in ("test.local", "test2.local")}
+    # nothing changed: only x/h
+    node.requests.clear()
+    mailer.getMail(cfgNode)
+    assert node.requests == ["/x/h/test.local/test2.local"]
+    # new message: counts and index tail of the changed echo only
+    node.add("test2.local", "%020d" % 10, fakeMsg("test2.local", 10))
+    node.requests.clear()
+    mailer.getMail(cfgNode)
+    assert node.requests[:3] == ["/x/h/test.local/test2.local",
+                                 "/x/c/test2.local", "/u/e/test2.local/5:65535"]
+    assert api.getEchoMsgids("test2.local") == node.echoes["test2.local"]
+    # same count, other messages: full index of the echo
+    node.echoes["test.local"][0] = "%020d" % 11
+    node.msgs["%020d" % 11] = fakeMsg("test.local", 11)
+    node.requests.clear()
+    mailer.getMail(cfgNode)
+    assert node.requests[:3] == ["/x/h/test.local/test2.local",
+                                 "/x/c/test.local", "/u/e/test.local"]
+    assert "%020d" % 11 in api.getEchoMsgids("test.local")
+    assert api.getNodeEchoCounts(cfgNode.nodename) == {"test.local": 5,
+                                                       "test2.local": 6}
+
+
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["sqlite"])
+def test_getMailEchoHashOffsets(api, node):
+    node, cfgNode = node
+    cfgNode.echoareas.append(config.Echo("test3.local", "", True))
+    for i in range(10, 15):
+        node.add("test3.local", "%020d" % i, fakeMsg("test3.local", i))
+    mailer.getMail(cfgNode)
+    # same offset 0 for test.local and test3.local, test2.local between them
+    node.echoes["test.local"][0] = "%020d" % 20
+    node.msgs["%020d" % 20] = fakeMsg("test.local", 20)
+    node.add("test2.local", "%020d" % 21, fakeMsg("test2.local", 21))
+    node.echoes["test3.local"][0] = "%020d" % 22
+    node.msgs["%020d" % 22] = fakeMsg("test3.local", 22)
+    node.requests.clear()
+    mailer.getMail(cfgNode)
+    assert "/u/e/test.local/test3.local" in node.requests
+    assert "/u/e/test2.local/5:65535" in node.requests
+    for echo in ("test.local", "test2.local", "test3.local"):
+        assert set(node.echoes[echo]) <= set(api.getEchoMsgids(echo))
+
+
+def runSync(sync):
+    sync.start()
+    while sync.is_alive():
+        sync.runPending()
+        time.sleep(0.001)
+    sync.runPending()
+
+
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["aio", "ait", "sqlite", "txt"])
+def test_syncThread(api, node, monkeypatch):
+    node, cfgNode = node
+    threads = set()
+    saveMessage = api.saveMessage
+
+    def saveMessageThread(*args):
+        threads.add(threading.get_ident())
+        return saveMessage(*args)
+
+    monkeypatch.setattr(api, "saveMessage", saveMessageThread)
+    sync = mailer.SyncThread([cfgNode])
+    runSync(sync)
+    assert sync.errors == {}
+    assert sync.status == "Получение сообщений: 10/10"
+    assert sync.takeSaved() == {"test.local", "test2.local"}
+    assert threads == {threading.get_ident()}  # storage is used by its owner
+    assert api.getEchoMsgids("test.local") == node.echoes["test.local"]
+    assert api.getEchoMsgids("test2.local") == node.echoes["test2.local"]
+
+
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["sqlite"])
+def test_syncThreadError(api, node):
+    node, cfgNode = node
+    cfgNode.url = node.url + "missing/"
+    sync = mailer.SyncThread([cfgNode])
+    runSync(sync)
+    assert list(sync.errors) == ["fake.node"]
+    assert sync.status.startswith("ОШИБКА: ")
+    assert sync.takeSaved() == set()
+
+
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["aio", "sqlite"])
+def test_syncThreadNodes(api, node):
+    node, cfgNode = node
+    with FakeNode() as node2:
+        node2.features = node.features
+        for i in range(5, 15):  # 5..9 are on both nodes
+            echo = "test.local" if i % 2 else "test2.local"
+            node2.add(echo, "%020d" % i, fakeMsg(echo, i))
+        cfgNode2 = config.Node(nodename="fake.node2", url=node2.url, echoareas=[
+            config.Echo("test.local", "", True),
+            config.Echo("test2.local", "", True)])
+        api.saveNodeFeatures(cfgNode2.nodename, node2.features)
+        api.saveNodeEchoCounts(cfgNode2.nodename, {})
+        # the first requests of the nodes wait for each other: synced one
+        # node after another, the barrier breaks and the sync fails
+        both = threading.Barrier(2, timeout=5)
+        met = set()
+
+        def meet(n):
+            def onRequest(path):
+                if n not in met:
+                    met.add(n)
+                    both.wait()
+            return onRequest
+
+        node.onRequest, node2.onRequest = meet(1), meet(2)
+        sync = mailer.SyncThread([cfgNode, cfgNode2])
+        runSync(sync)
+    assert sync.errors == {}
+    assert sync.done == 2
+    assert not both.broken
+    msgids = api.getEchoMsgids("test.local") + api.getEchoMsgids("test2.local")
+    assert sorted(msgids) == ["%020d" % i for i in range(15)]  # fetched once
+    assert api.getNodeEchoCounts(cfgNode2.nodename) == {"test.local": 5,
+                                                        "test2.local": 5}
+
+
+def writeToss(cfgNode, msgs):
+    os.makedirs(mailer.directory(cfgNode), exist_ok=True)
+    for i, msg in enumerate(msgs):
+        with open(mailer.directory(cfgNode) + "%d.outmsg.toss" % i, "w") as f:
+            f.write(base64.b64encode(msg.encode("utf-8")).decode("ascii"))
+
+
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["sqlite"])
+def test_sendMail(node):
+    node, cfgNode = node
+    cfgNode.auth = node.auth
+    writeToss(cfgNode, [fakeMsg("test.local", i) for i in range(12)])
+    node.onRequest = waitActive(node, aclient.NODE_REQUESTS)
+    mailer.sendMail(cfgNode)
+    assert sorted(node.posted) == sorted(fakeMsg("test.local", i) for i in range(12))
+    assert node.maxActive == aclient.NODE_REQUESTS  # uploaded concurrently
+    assert not [f for f in os.listdir(mailer.directory(cfgNode)) if f.endswith(".toss")]
+
+
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["sqlite"])
+def test_sendMailPushNode(api, node):
+    node, cfgNode = node
+    cfgNode.auth = node.auth
+    msgs = [fakeMsg("test.local", i) for i in range(3)]
+    msgs[1] = "big" * 30000
+    writeToss(cfgNode, msgs)
+    # u/push takes node bundles, not the point messages
+    node.features.append(FEAT_U_PUSH)
+    api.saveNodeFeatures(cfgNode.nodename, node.features)
+    mailer.sendMail(cfgNode)
+    assert node.requests == ["/u/point"] * 3
+    assert sorted(node.posted) == sorted([msgs[0], msgs[2]])
+    # rejected message stays in outbox
+    assert [f for f in os.listdir(mailer.directory(cfgNode))
+            if f.endswith(".toss")] == ["1.outmsg.toss"]
+
+
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["aio", "ait", "sqlite", "txt"])
+def test_getMailResume(api, node, monkeypatch):
+    node, cfgNode = node
+    monkeypatch.setattr(mailer, "BUNDLE_MIN", 10)
+    monkeypatch.setattr(mailer, "BUNDLE_MAX", 10)
+    for i in range(10, 300):
+        echo = "test.local" if i % 2 else "test2.local"
+        node.add(echo, "%020d" % i, fakeMsg(echo, i))
+    node.bundlesLeft = 12  # node fails in the middle of the fetch
+    with pytest.raises(client.urllib.error.HTTPError):
+        mailer.getMail(cfgNode)
+    journal = mailer.directory(cfgNode) + mailer.JOURNAL
+    assert os.path.exists(journal)
+    saved = api.getEchoMsgids("test.local") + api.getEchoMsgids("test2.local")
+    assert 0 < len(saved) < 300
+    assert api.getNodeEchoCounts(cfgNode.nodename) == {}  # not synced yet
+    # restart after the crash: no index requests, only the missing messages
+    node.bundlesLeft = None
+    node.requests.clear()
+    mailer.getMail(cfgNode)
+    assert not os.path.exists(journal)
+    fetched = [m for r in node.requests if r.startswith("/u/m/")
+               for m in r[len("/u/m/"):].split("/")]
+    assert sorted(fetched + saved) == ["%020d" % i for i in range(300)]
+    assert not [r for r in node.requests if r.startswith("/u/e/")]
+    assert api.getEchoMsgids("test.local") == node.echoes["test.local"]
+    assert api.getEchoMsgids("test2.local") == node.echoes["test2.local"]
+    assert api.getNodeEchoCounts(cfgNode.nodename) == {"test.local": 150,
+                                                       "test2.local": 150}
+
+
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["sqlite"])
+def test_getMailResumeSavedUnjournaled(api, node):
+    node, cfgNode = node
+    journal = mailer.directory(cfgNode) + mailer.JOURNAL
+    msgids = ["%020d" % i for i in range(10)]
+    # crashed after saving the first bundle, before its journal record
+    mailer.debundle(client.getBundle(node.url, "/".join(msgids[:5])),
+                    msgids[:5], cfgNode)
+    mailer._writeJournal(journal, {"counts": None, "hashes": None}, msgids)
+    with open(journal, "a") as f:
+        f.write("+")  # torn record
+    node.requests.clear()
+    mailer.resumeMail(cfgNode, journal)
+    assert node.requests == ["/u/m/" + "/".join(msgids[5:])]
+    assert not os.path.exists(journal)
+    assert sorted(api.getEchoMsgids("test.local")
+                  + api.getEchoMsgids("test2.local")) == msgids
+
+
+# noinspection PyTestParametrized
+@pytest.mark.parametrize("storage", ["sqlite"])
+def test_getMailImportOnlyIntoSmallStore(api, node, monkeypatch):
+    node, cfgNode = node
+    monkeypatch.setattr(mailer, "IMPORT_SIZE", 5)
+    imports = []
+    monkeypatch.setattr(api, "beginImport", lambda: imports.append(True))
+    monkeypatch.setattr(api, "endImport", lambda: None)
+    mailer.getMail(cfgNode)
+    assert imports == [True]  # 10 messages into the empty store
+    for i in range(10, 16):
+        echo = "test.local" if i % 2 else "test2.local"
+        node.add(echo, "%020d" % i, fakeMsg(echo, i))
+    mailer.getMail(cfgNode)
+    assert imports == [True]  # 6 messages into the 10 stored ones
+    assert len(api.getEchoMsgids("test.local")
+               + api.getEchoMsgids("test2.local")) == 16
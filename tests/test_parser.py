@@ -360,6 +360,25 @@ def test_findVisibleToken():
     assert tokens[y].render[offset] == "//url-with"
 
 
+@pytest.mark.parametrize("inline", [False, True])
+def test_tokenizeChunk(inline):
+    parser.INLINE_STYLE_ENABLED = inline
+    b64 = base64.b64encode(b"0123456789" * 20).decode()
+    lines = ["Text **bold**", "====", "code", "", "code", "====",
+             "> quote", "@base64:file.txt",
+             *textwrap.wrap(b64, 40), "", "```", "code2", "```", "end"]
+    expected = parser.tokenize(lines)
+    assert any(t.filename == "file.txt" for t in expected) == inline
+    for size in range(1, len(lines) + 1):
+        tokens = []
+        line, inCode = 0, False
+        while line < len(lines):
+            chunk, line, inCode = parser.tokenizeChunk(
+                lines[line:], line, inCode, line + size)
+            tokens.extend(chunk)
+        assert tokens == expected, size
+
+
 def test_scrollableSize():
     tokens = parser.tokenize([""])
     assert parser.prerender(tokens, width=10) == (1, 10, False)
@@ -1,4 +1,5 @@
 import curses
+import time
 
 import pytest
 
@@ -330,3 +331,281 @@ def test_renderScrollableSize():
     assert r.scrollH.isScrollable
     assert r.scrollH.content == 20
     assert r.scrollH.view == 9
+
+
+class _FindApi:
+    FIND_OK = 0
+    FIND_CANCEL = 1
+
+    @staticmethod
+    def iterQueryMsgids(fq, progressHandler):
+        for i in range(3, 0, -1):
+            if progressHandler(None) == _FindApi.FIND_CANCEL:
+                return
+            yield MsgMetadata(str(i), "", "", i, "", "", "", "")
+
+
+def test_findStream(monkeypatch):
+    monkeypatch.setattr(ui, "API", _FindApi)
+    stream = ui.FindStream(ui.FindQuery())
+    stream.thread.join()
+    assert stream.done
+    assert [m.msgid for m in stream.data] == ["3", "2", "1"]
+    #
+    reader = EchoReaderScreen.__new__(EchoReaderScreen)
+    reader.stack = []
+    reader.stream = stream
+    reader.msgs = MsgModeStack(ReaderMode.FIND, stream.data, 0)
+    reader.msgs.push(ReaderMode.SUBJ, [stream.data[1]])
+    reader.findDone()
+    assert not reader.stream
+    assert [m.msgid for m in stream.data] == ["1", "2", "3"]
+    assert reader.msgs.stack == [(ReaderMode.FIND, stream.data, 2)]
+
+
+def test_findStreamCancel(monkeypatch):
+    monkeypatch.setattr(ui, "API", _FindApi)
+    stream = ui.FindStream.__new__(ui.FindStream)
+    stream.cancel = True
+    assert stream._progress(None) == _FindApi.FIND_CANCEL
+
+
+def test_twitMask(monkeypatch):
+    monkeypatch.setattr(ui.CFG, "twit", ["troll"])
+
+    def meta(msgid, fr, to="All"):
+        return MsgMetadata(msgid, "", "", 0, fr, "", to, "")
+    msgs = MsgModeStack(ReaderMode.ECHO,
+                        [meta("0", "a"), meta("1", "troll"), meta("2", "b", "troll")], 0)
+    assert [msgs.isTwit(i) for i in range(-1, 4)] == [False, False, True, True, False]
+    assert msgs.twitMask == [False, True, True]
+    # found messages appended
+    msgs.data.append(meta("3", "troll"))
+    assert msgs.isTwit(3)
+    assert msgs.twitMask == [False, True, True, True]
+    # new list
+    msgs.push(ReaderMode.SUBJ, [meta("1", "troll"), meta("4", "c")])
+    assert msgs.twitMask is None
+    assert [msgs.isTwit(i) for i in range(2)] == [True, False]
+    msgs.pop()
+    assert [msgs.isTwit(i) for i in range(4)] == [False, True, True, True]
+
+
+def test_quickSearchNarrow():
+    items = ["abc", "abd", "xab", "bcd", "ABCD"]
+    tested = []
+
+    def matcher(sidx, pattern, item):
+        tested.append(item)
+        return [m for m in pattern.finditer(item)] or None
+
+    qs = QuickSearch(items, matcher)
+    qs.search("ab", 1)
+    assert qs.result == [0, 1, 2, 4]
+    assert qs.byPos == {0: 0, 1: 1, 2: 2, 4: 3}
+    assert qs.idx == 1
+    assert len(tested) == 5
+    # extended query re-tests the matched items only
+    tested.clear()
+    qs.search("abc", 0)
+    assert tested == ["abc", "abd", "xab", "ABCD"]
+    assert qs.result == [0, 4]
+    assert qs.byPos == {0: 0, 4: 1}
+    assert qs.idx == 0
+    # shortened query widens
+    tested.clear()
+    qs.search("bc", 0)
+    assert len(tested) == 5
+    assert qs.result == [0, 3, 4]
+    # regex query can't be narrowed
+    tested.clear()
+    qs.search("bc|x", 0)
+    assert len(tested) == 5
+    assert qs.result == [0, 2, 3, 4]
+    assert qs.byPos == {0: 0, 2: 1, 3: 2, 4: 3}
+
+
+def test_quickSearchByPosMultiMatch():
+    items = ["a", "aa", "b", "aaa"]
+    qs = QuickSearch(items, lambda sidx, p, it: list(p.finditer(it)) or None)
+    qs.search("a", 2)
+    assert qs.result == [0, 1, 1, 3, 3, 3]
+    assert qs.byPos == {0: 0, 1: 1, 3: 3}
+    assert qs.idx == 3
+    qs.search("aa", 0)
+    assert qs.result == [1, 3]
+    assert qs.byPos == {1: 0, 3: 1}
+    qs.search("", 0)
+    assert not qs.result and not qs.byPos
+
+
+@pytest.mark.parametrize("storage", ["aio", "ait", "sqlite", "txt"])
+def test_msgCachePrefetch(api, monkeypatch):
+    monkeypatch.setattr(ui, "API", api)
+    api.saveMessage([("%020d" % i, ["ii/ok", "test.local", str(i), "admin",
+                                    "node,1", "All", "Subj %d" % i, "",
+                                    "Body %d" % i]) for i in range(5)],
+                    "node", "user")
+    data = api.getEchoMsgsMetadata("test.local")
+    cache = ui.MsgCache(size=3)
+    cache.prefetch(data[1:4], 20, 10)
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        with cache.lock:
+            if len(cache.items) == 3 and all(it[2] for it in cache.items.values()):
+                break
+        time.sleep(0.01)
+    cache.stop()
+    assert list(cache.items) == [m.msgid for m in data[1:4]]
+
+    def readMsg(msgid, echo):
+        raise AssertionError("not prefetched " + msgid)
+    monkeypatch.setattr(api, "readMsg", readMsg)
+    msg, size = cache.read(data[2].msgid, "test.local")
+    assert msg[6] == "Subj 2" and size
+    rendered = cache.render(data[2].msgid, msg, 20, 10)
+    assert rendered is cache.items[data[2].msgid][2]
+    assert [t.render for t in rendered.tokens] == [
+        t.render for t in ui.MsgRender(msg, 20, 10).tokens]
+    # other width is re-wrapped, not tokenized again
+    tokens = list(rendered.tokens)
+    assert cache.render(data[2].msgid, msg, 30, 10) is rendered
+    assert rendered.tokens == tokens and rendered.tokens[0] is tokens[0]
+    assert rendered.wrapKey == (30, 10, False)
+    # least recently used is dropped
+    monkeypatch.undo()
+    monkeypatch.setattr(ui, "API", api)
+    cache.read(data[0].msgid, "test.local")
+    assert list(cache.items) == [data[3].msgid, data[2].msgid, data[0].msgid]
+    # missing message isn't cached
+    cache.read("missing", "test.local")
+    assert "missing" not in cache.items
+
+
+def test_msgRenderLazy(monkeypatch):
+    body = []
+    for i in range(50):
+        body.extend(["Line %d with some words to wrap" % i, "====", "code", "===="])
+    msg = [""] * 8 + body
+    full = ui.MsgRender(msg, 20, 10)
+    assert full.done
+    monkeypatch.setattr(ui, "LAZY_LINES", 30)
+    lazy = ui.MsgRender(msg, 20, 10)
+    assert not lazy.tokens and lazy.estimate() == len(body)
+    assert lazy.extendTo(10)
+    assert lazy.line == 30 and not lazy.done
+    assert lazy.tokens == full.tokens[:len(lazy.tokens)]
+    assert lazy.height < lazy.estimate() < full.height * 2
+    lazy.extendTo(lazy.height + 1)
+    assert lazy.line == 60
+    assert lazy.extendTo()
+    assert lazy.done and not lazy.extendTo()
+    assert lazy.tokens == full.tokens
+    assert lazy.height == lazy.estimate() == full.height
+    assert lazy.t2l == full.t2l
+
+
+def test_readerLazy(monkeypatch):
+    monkeypatch.setattr(ui, "LAZY_LINES", 30)
+    r = ui.ReaderWidget()
+    r.setRect(x=0, y=5, w=20, h=10)
+    r.setMsg([""] * 8 + ["Line %d" % i for i in range(1000)], 0)
+    r.prerender()
+    assert r.rendered.line == 30
+    assert r.scrollV.content == 1000 and r.scrollV.isScrollable
+    r.prerender(100)
+    assert r.rendered.line == 120 and r.scrollV.pos == 100
+    r.draw(ScrMock(30, 20))
+    assert r.rendered.line == 120
+    r.scrollV.pos = 200
+    r.draw(ScrMock(30, 20))
+    assert r.rendered.line == 240
+    monkeypatch.setattr(ui.Reader.MEND, "ks", ["End"])
+    assert r.onKeyPressed("End", 0)
+    assert r.rendered.done
+    assert r.scrollV.pos == 1000 - 10
+
+
+@pytest.mark.parametrize("lazyLines", [1000, 30])
+def test_msgRenderRewrap(monkeypatch, lazyLines):
+    monkeypatch.setattr(ui, "LAZY_LINES", lazyLines)
+    msg = [""] * 8 + ["Line %d with some words to wrap" % i for i in range(100)]
+    rendered = ui.renderMsg(msg, 20, 10)
+    rendered.extendTo(40)
+    tokens = rendered.tokens[0]
+    assert ui.renderMsg(msg, 20, 10, rendered) is rendered
+    assert not rendered.rewrap(20, 10)
+    #
+    assert ui.renderMsg(msg, 40, 10, rendered) is rendered
+    assert rendered.tokens[0] is tokens
+    fresh = ui.renderMsg(msg, 40, 10)
+    fresh.extendTo(rendered.line and rendered.height)
+    assert fresh.line == rendered.line
+    assert [t.render for t in rendered.tokens] == [t.render for t in fresh.tokens]
+    assert (rendered.height, rendered.maxWidth, rendered.hScroll, rendered.t2l) == (
+        fresh.height, fresh.maxWidth, fresh.hScroll, fresh.t2l)
+    # tokens depend on the inline style
+    monkeypatch.setattr(parser, "INLINE_STYLE_ENABLED", True)
+    assert ui.renderMsg(msg, 40, 10, rendered) is not rendered
+    # other message
+    assert ui.renderMsg(list(msg), 40, 10, rendered) is not rendered
+
+
+class KeysScrMock:
+    def __init__(self, keys):
+        self.keys = keys  # type: list
+        self.timeouts = []
+
+    def timeout(self, ms):
+        self.timeouts.append(ms)
+
+    def getch(self):
+        return self.keys.pop(0) if self.keys else -1
+
+
+def test_skipResizes(monkeypatch):
+    scr = KeysScrMock([curses.KEY_RESIZE, curses.KEY_RESIZE, ord("j"),
+                       curses.KEY_RESIZE])
+    monkeypatch.setattr(ui, "stdscr", scr)
+    monkeypatch.setattr(ui.keystroke, "PENDING_KEYS", [curses.KEY_RESIZE])
+    ui._skipResizes()
+    assert ui.keystroke.PENDING_KEYS == [ord("j"), curses.KEY_RESIZE]
+    assert ui.RESIZE_DELAY in scr.timeouts
+    # nothing comes after the resize
+    scr.keys = []
+    ui.keystroke.PENDING_KEYS[:] = [curses.KEY_RESIZE]
+    ui._skipResizes()
+    assert ui.keystroke.PENDING_KEYS == []
+
+
+class SyncMock:
+    def __init__(self):
+        self.alive = True
+        self.saved = set()
+        self.status = ""
+
+    def is_alive(self):
+        return self.alive
+
+    def runPending(self):
+        pass
+
+    def takeSaved(self):
+        saved, self.saved = self.saved, set()
+        return saved
+
+
+def test_runSyncFinishedOnce(monkeypatch):
+    sync = SyncMock()
+    calls = []
+    monkeypatch.setattr(ui, "sync", sync)
+    monkeypatch.setattr(ui, "onSyncSaved", lambda saved, finished: calls.append((saved, finished)))
+    monkeypatch.setattr(ui, "statusBar", None)
+    ui.runSync()
+    sync.saved = {"test.local"}
+    ui.runSync()
+    sync.alive = False
+    sync.saved = {"test2.local"}
+    ui.runSync()
+    ui.runSync()
+    assert calls == [({"test.local"}, False), ({"test2.local"}, True)]
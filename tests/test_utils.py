@@ -10,3 +10,16 @@ def test_offsets_echo_count():
     #
     offsets = utils.offsetsEchoCount({"echo.1": 1}, {"echo.1": 1})
     assert offsets == {}
+
+
+def test_offsets_echo_hash():
+    old = {"echo.1": 1, "echo.2": 2, "echo.3": 3}
+    new = {"echo.1": 1, "echo.2": 2, "echo.3": 4, "echo.4": 1}
+    offsets = utils.offsetsEchoHash(old, new,
+                                    {"echo.1": "a", "echo.2": "b", "echo.3": "c"},
+                                    {"echo.1": "a", "echo.2": "x", "echo.3": "y",
+                                     "echo.4": "z"})
+    assert offsets == {"echo.2": 0, "echo.3": 3, "echo.4": 0}
+    #
+    offsets = utils.offsetsEchoHash(old, new, {}, {})
+    assert offsets == utils.offsetsEchoCount(old, new)